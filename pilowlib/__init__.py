@@ -19,8 +19,13 @@
 peripherals of the Raspberry PI. Currently, besides the raw access
 to the registers, the following peripherals are supported:
     * simple digital I/O
+    * GPIO edge and level events
     * PWM
+    * SPI (SPI0, SPI1 and SPI2)
     * clocks
+    * system timer
+    * ARM timer
+    * DMA
     
 Parts of this library were inspired from the wiringPi project
 written by Gordon Henderson.
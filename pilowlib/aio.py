@@ -0,0 +1,193 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides asyncio coroutines for waiting on GPIO pins,
+transferring data over SPI0 and feeding the PWM FIFO.
+The hardware is polled adaptively: right after some progress
+the coroutines only yield to the event loop between checks,
+then they sleep for increasing periods of time,
+so that idle waits cost little CPU time.
+Timeouts are obtained with asyncio.wait_for().
+This module requires Python 3.7 or newer.
+'''
+
+import asyncio
+import weakref
+
+from pilowlib import events
+from pilowlib import funcs
+from pilowlib import regs
+from pilowlib import spi
+
+_POLL_SPINS = 16 # the number of checks done before starting to sleep
+_POLL_MIN_INTERVAL = 0.0001 # the first sleep period, in seconds
+_POLL_MAX_INTERVAL = 0.01 # the longest sleep period, in seconds
+
+# serializes the SPI transfers of the coroutines, one lock per event loop
+_spi_locks = weakref.WeakKeyDictionary()
+
+
+class _Poll(object):
+    '''Implements the adaptive polling delay.'''
+
+    def __init__(self, max_interval=_POLL_MAX_INTERVAL):
+        self.max_interval = max_interval
+        self.reset()
+
+    def reset(self):
+        '''Called whenever progress is made.'''
+
+        self.spins = 0
+        self.interval = _POLL_MIN_INTERVAL
+
+    async def wait(self):
+        '''Called whenever no progress is made.'''
+
+        if self.spins < _POLL_SPINS:
+            self.spins += 1
+            await asyncio.sleep(0)
+
+        else:
+            await asyncio.sleep(self.interval)
+            self.interval = min(self.interval * 2, self.max_interval)
+
+
+async def wait_for_level(gpio, level, max_interval=_POLL_MAX_INTERVAL):
+    '''Waits until a GPIO pin has the given digital value.
+    @param gpio: the number of the GPIO pin
+    @param level: the awaited value (a boolean)
+    @param max_interval: the longest time between two checks, in seconds
+    '''
+
+    if gpio < 0 or gpio > funcs.MAX_GPIO:
+        raise Exception('Invalid GPIO number')
+
+    lev_reg = regs.register('GPLEV%d' % (gpio // 32))
+    mask = 1 << (gpio % 32)
+    value = mask if level else 0
+
+    poll = _Poll(max_interval)
+    while lev_reg.get() & mask != value:
+        await poll.wait()
+
+
+async def wait_for_edge(gpio, edges=events.BOTH, max_interval=_POLL_MAX_INTERVAL):
+    '''Waits for an edge on a GPIO pin, using the hardware
+    edge detection (see the events module), so that short pulses
+    are not missed between two checks. The detection of the given
+    edges is enabled by the first call (discarding any earlier event)
+    and is left enabled afterwards, so that the edges occurring between
+    two calls are not lost.
+    Returns the level of the pin after the edge.
+    @param gpio: the number of the GPIO pin
+    @param edges: events.RISING, events.FALLING or events.BOTH
+    (or their asynchronous counterparts)
+    @param max_interval: the longest time between two checks, in seconds
+    '''
+
+    if events.enabled(gpio) != edges:
+        events.enable(gpio, edges)
+
+    eds_reg = regs.register('GPEDS%d' % (gpio // 32))
+    lev_reg = regs.register('GPLEV%d' % (gpio // 32))
+    mask = 1 << (gpio % 32)
+
+    poll = _Poll(max_interval)
+    while not eds_reg.get() & mask:
+        await poll.wait()
+
+    # clear only the event of this pin
+    eds_reg.set(mask)
+
+    return bool(lev_reg.get() & mask)
+
+
+async def spi_transfer(data, max_interval=_POLL_MAX_INTERVAL):
+    '''Writes and reads bytes to and from SPI0, as configured
+    by spi.configure(). The TX FIFO is kept filled while the RX FIFO
+    is drained, yielding to the event loop whenever the SPI
+    peripheral is busy. Concurrent transfers are serialized, along with
+    the transfers done by the other modules (see spi.Bus).
+    Returns the bytes that were read, as a bytearray.
+    @param data: the bytes to write (bytes, bytearray or memoryview)
+    @param max_interval: the longest time between two checks, in seconds
+    '''
+
+    loop = asyncio.get_running_loop()
+    lock = _spi_locks.get(loop)
+    if lock is None:
+        lock = _spi_locks[loop] = asyncio.Lock()
+
+    data = spi._byte_buffer(data)
+    length = len(data)
+    read_data = bytearray(length)
+
+    async with lock:
+        await _spi_transfer(data, read_data, length, max_interval)
+
+    return read_data
+
+
+async def _spi_transfer(data, read_data, length, max_interval):
+    # the SPI lock is shared with the threads, so it is not waited for
+    # in a blocking way, which would block the event loop as well;
+    # it is owned by the task, so that the synchronous SPI0 functions
+    # called by the other code of the event loop cannot get in meanwhile
+    poll = _Poll(max_interval)
+    while not spi._lock.acquire(blocking=False, owner=asyncio.current_task()):
+        await poll.wait()
+
+    try:
+        poll.reset()
+        steps = spi._transfer_steps(data, read_data, length)
+        try:
+            for progress in steps:
+                if progress:
+                    poll.reset()
+
+                else:
+                    await poll.wait()
+
+        finally:
+            # aborts the transfer if cancelled
+            steps.close()
+
+    finally:
+        spi._lock.release()
+
+
+async def pwm_feed(values, max_interval=_POLL_MAX_INTERVAL):
+    '''Adds values to the PWM FIFO, yielding to the event loop
+    whenever the FIFO is full.
+    Returns the number of values that were added.
+    @param values: an iterable of integers (e.g. a list or an array)
+    @param max_interval: the longest time between two checks, in seconds
+    '''
+
+    poll = _Poll(max_interval)
+    count = 0
+    for value in values:
+        if regs.PWMSTA & 0x01: # FIFO full
+            while regs.PWMSTA & 0x01:
+                await poll.wait()
+
+            poll.reset()
+
+        regs.PWMFIF = value
+        count += 1
+
+    return count
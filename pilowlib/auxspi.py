@@ -0,0 +1,271 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides configuration and control for the auxiliary SPI
+peripherals of the RPi (SPI1 and SPI2, numbered 1 and 2), which are
+part of the AUX block. Their FIFOs are 4 entries deep, and each entry
+shifts up to 24 bits, so the data is transferred in units of
+1 to 24 bits (8 by default), packing as many units as fit in an entry.
+The pins must be switched to the SPI1_*/SPI2_* functions separately
+(see the funcs module).
+'''
+
+from pilowlib import regs
+from pilowlib import spi
+
+# AUXENB bits
+_ENB_SPI = {1: 0x02, 2: 0x04}
+
+# SPIxCNTL0 bits
+_CNTL0_MSBF_OUT = 0x40
+_CNTL0_CPOL = 0x80
+_CNTL0_OUT_RISING = 0x100
+_CNTL0_CLEAR_FIFO = 0x200
+_CNTL0_IN_RISING = 0x400
+_CNTL0_ENABLE = 0x800
+_CNTL0_VAR_WIDTH = 0x4000
+_CNTL0_CS_SHIFT = 17
+_CNTL0_SPEED_SHIFT = 20
+
+# SPIxCNTL1 bits
+_CNTL1_MSBF_IN = 0x02
+
+# SPIxSTAT bits
+_STAT_RX_EMPTY = 0x80
+_STAT_TX_FULL = 0x400
+
+_FIFO_SIZE = 4 # the number of entries allowed in flight
+_ENTRY_BITS = 24 # the number of data bits of a FIFO entry
+_WIDTH_SHIFT = 24 # the position of the shift length in a FIFO entry
+
+_stat_regs = {1: regs.register('SPI1STAT'), 2: regs.register('SPI2STAT')}
+_io_regs = {1: regs.register('SPI1IO'), 2: regs.register('SPI2IO')}
+_txhold_regs = {1: regs.register('SPI1TXHOLD'), 2: regs.register('SPI2TXHOLD')}
+
+
+def configure(spi_no, clock_rest_polarity=0, clock_phase=1, clock_divider=0, chip_select=0):
+    '''Enables and configures an auxiliary SPI peripheral.
+    The data is always shifted out and in MSB first.
+    @param spi_no: the number of the SPI peripheral (1 or 2)
+    @param clock_rest_polarity: sets the polarity of the clock signal
+    when not transmitting data to either 0 or 1
+    @param clock_phase: if set to 0, the clock transition will take place
+    in the middle of the data bit; if set to 1, the clock transition happens
+    at the beginning of the data bit
+    @param clock_divider: a value between 0 and 4095; the SPI clock
+    is the system clock divided by 2 * (clock_divider + 1)
+    @param chip_select: the chip select line (0, 1 or 2) that is held to 0
+    when transmitting data; if None is passed, no chip select
+    is asserted at all during transmission
+    '''
+
+    if spi_no not in _ENB_SPI:
+        raise Exception('Invalid SPI number')
+
+    if clock_divider < 0 or clock_divider > 0xFFF:
+        raise Exception('Invalid clock divider')
+
+    cs_pattern = 0x07
+    if chip_select is not None:
+        if chip_select < 0 or chip_select > 2:
+            raise Exception('Invalid chip select')
+
+        cs_pattern &= ~(1 << chip_select)
+
+    value = _CNTL0_ENABLE | _CNTL0_VAR_WIDTH | _CNTL0_MSBF_OUT
+    value |= cs_pattern << _CNTL0_CS_SHIFT
+    value |= clock_divider << _CNTL0_SPEED_SHIFT
+
+    if clock_rest_polarity:
+        value |= _CNTL0_CPOL
+
+    # data is shifted out on one clock edge and sampled on the other one
+    if bool(clock_rest_polarity) != bool(clock_phase):
+        value |= _CNTL0_OUT_RISING
+
+    else:
+        value |= _CNTL0_IN_RISING
+
+    # the peripheral must be enabled before its registers can be accessed
+    regs.modify('AUXENB', 0, _ENB_SPI[spi_no])
+
+    regs.register('SPI%dCNTL0' % spi_no).set(_CNTL0_CLEAR_FIFO)
+    regs.register('SPI%dCNTL1' % spi_no).set(_CNTL1_MSBF_IN)
+    regs.register('SPI%dCNTL0' % spi_no).set(value)
+
+
+def disable(spi_no):
+    '''Disables an auxiliary SPI peripheral.
+    @param spi_no: the number of the SPI peripheral (1 or 2)
+    '''
+
+    if spi_no not in _ENB_SPI:
+        raise Exception('Invalid SPI number')
+
+    regs.register('SPI%dCNTL0' % spi_no).set(0)
+    regs.modify('AUXENB', _ENB_SPI[spi_no], 0)
+
+
+def transfer(spi_no, data, bits=8):
+    '''Reads and writes a buffer of units from and to the SPI.
+    @param spi_no: the number of the SPI peripheral (1 or 2)
+    @param data: the units to write; a bytes-like object for 8 bit units,
+    a sequence of integers (e.g. an array) otherwise
+    @param bits: the width of a unit (1 to 24)
+    @return: the units that were read, as a bytearray for 8 bit units,
+    a list of integers otherwise
+    '''
+
+    if bits == 8:
+        data = spi._byte_buffer(data)
+        read_data = bytearray(len(data))
+
+    else:
+        read_data = [0] * len(data)
+
+    _transfer(spi_no, data, read_data, len(data), 0, bits)
+
+    return read_data
+
+
+def transfer_into(spi_no, data, read_data, bits=8):
+    '''Reads and writes units from and to the SPI using
+    caller-provided buffers, without allocating any memory.
+    As many units as there are in data are transferred.
+    @param spi_no: the number of the SPI peripheral (1 or 2)
+    @param data: the units to write (see transfer())
+    @param read_data: the writable buffer to read into, at least as long
+    as data; a buffer-protocol object for 8 bit units, a writable
+    sequence of integers (e.g. an array) otherwise
+    @param bits: the width of a unit (1 to 24)
+    @return: the number of transferred units
+    '''
+
+    if bits == 8:
+        data = spi._byte_buffer(data)
+        read_data = spi._writable_byte_buffer(read_data)
+
+    if len(read_data) < len(data):
+        raise Exception('Read buffer too small')
+
+    _transfer(spi_no, data, read_data, len(data), 0, bits)
+
+    return len(data)
+
+
+def write(spi_no, data, bits=8):
+    '''Writes units to the SPI, discarding the units that are read.
+    @param spi_no: the number of the SPI peripheral (1 or 2)
+    @param data: the units to write (see transfer())
+    @param bits: the width of a unit (1 to 24)
+    @return: the number of transferred units
+    '''
+
+    if bits == 8:
+        data = spi._byte_buffer(data)
+
+    _transfer(spi_no, data, None, len(data), 0, bits)
+
+    return len(data)
+
+
+def read_into(spi_no, read_data, fill=0x00, bits=8):
+    '''Reads units from the SPI into a caller-provided buffer,
+    writing the same unit over and over.
+    @param spi_no: the number of the SPI peripheral (1 or 2)
+    @param read_data: the writable buffer to read into
+    (see transfer_into()); it is filled entirely
+    @param fill: the unit to write
+    @param bits: the width of a unit (1 to 24)
+    @return: the number of transferred units
+    '''
+
+    if bits == 8:
+        read_data = spi._writable_byte_buffer(read_data)
+
+    _transfer(spi_no, None, read_data, len(read_data), fill, bits)
+
+    return len(read_data)
+
+
+def _transfer(spi_no, data, read_data, length, fill, bits):
+    '''Writes length units and reads the same number of units,
+    packing as many units as possible in each FIFO entry.
+    The FIFO entries are written to the TXHOLD register, which keeps
+    the chip select asserted, except for the last one, written to
+    the IO register, after which the chip select is released.
+    @var spi_no: the number of the SPI peripheral (1 or 2)
+    @var data: a sequence of units to write;
+    if None, the fill unit is written instead
+    @var read_data: a writable sequence of units to read into;
+    if None, the read units are discarded
+    @var length: the number of units to transfer
+    @var fill: the unit to write when data is None
+    @var bits: the width of a unit (1 to 24)
+    '''
+
+    if spi_no not in _ENB_SPI:
+        raise Exception('Invalid SPI number')
+
+    if bits < 1 or bits > _ENTRY_BITS:
+        raise Exception('Invalid unit width')
+
+    per_entry = _ENTRY_BITS // bits
+    mask = (1 << bits) - 1
+    fill &= mask
+
+    stat_reg = _stat_regs[spi_no]
+    words = stat_reg.mapped_words()
+    stat_index = stat_reg.index
+    io_index = _io_regs[spi_no].index
+    txhold_index = _txhold_regs[spi_no].index
+
+    entries = (length + per_entry - 1) // per_entry
+    written = 0 # the number of written entries
+    read = 0 # the number of read entries
+    tx_pos = 0 # the number of written units
+    rx_pos = 0 # the number of read units
+    while read < entries:
+        status = words[stat_index]
+
+        # top up the TX fifo, without overflowing the RX fifo
+        while written < entries and written - read < _FIFO_SIZE and not status & _STAT_TX_FULL:
+            count = min(length - tx_pos, per_entry)
+            shift = _ENTRY_BITS
+            entry = (count * bits) << _WIDTH_SHIFT
+            for i in range(tx_pos, tx_pos + count):
+                shift -= bits
+                entry |= ((data[i] & mask) if data is not None else fill) << shift
+
+            tx_pos += count
+            written += 1
+            words[txhold_index if written < entries else io_index] = entry
+            status = words[stat_index]
+
+        # drain the RX fifo; the units are shifted in from the right
+        while read < written and not status & _STAT_RX_EMPTY:
+            entry = words[io_index]
+            count = min(length - rx_pos, per_entry)
+            if read_data is not None:
+                shift = count * bits
+                for i in range(rx_pos, rx_pos + count):
+                    shift -= bits
+                    read_data[i] = (entry >> shift) & mask
+
+            rx_pos += count
+            read += 1
+            status = words[stat_index]
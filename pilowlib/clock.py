@@ -20,7 +20,7 @@ There are 3 general purpose clocks (numbered from 0 to 2)
 and a clock that drives the PWM peripherals, identified as 'pwm'.
 '''
 
-import regs
+from pilowlib import regs
 
 # clock sources
 SRC_GND = 0
@@ -30,6 +30,7 @@ SRC_TEST_DEBUG1 = 3
 SRC_PLLA = 4
 SRC_PLLB = 5
 SRC_PLLC = 6
+SRC_PLLD = 6 # the datasheet name of source 6 (500 MHz)
 SRC_HDMI_AUX = 7
 
 
@@ -76,19 +77,21 @@ def start(clock_no):
     if clock_no != 'pwm' and (clock_no < 0 or clock_no > 2):
         raise Exception('Invalid clock number')
 
-    ctl = 0x5A000010
+    # replace the password field and set the ENAB bit
+    clr_mask = 0xFF000000
+    set_mask = 0x5A000010
 
     if clock_no == 'pwm':
-        regs.CLKPWMCTL |= ctl
+        regs.modify('CLKPWMCTL', clr_mask, set_mask)
 
     elif clock_no == 0:
-        regs.CLKGP0CTL |= ctl
+        regs.modify('CLKGP0CTL', clr_mask, set_mask)
 
     elif clock_no == 1:
-        regs.CLKGP1CTL |= ctl
+        regs.modify('CLKGP1CTL', clr_mask, set_mask)
 
     elif clock_no == 2:
-        regs.CLKGP2CTL |= ctl
+        regs.modify('CLKGP2CTL', clr_mask, set_mask)
 
 
 def stop(clock_no):
@@ -99,19 +102,21 @@ def stop(clock_no):
     if clock_no != 'pwm' and (clock_no < 0 or clock_no > 2):
         raise Exception('Invalid clock number')
 
-    ctl = 0x5A000000 + ~0x000010
+    # replace the password field and clear the ENAB bit
+    clr_mask = 0xFF000010
+    set_mask = 0x5A000000
 
     if clock_no == 'pwm':
-        regs.CLKPWMCTL &= ctl
+        regs.modify('CLKPWMCTL', clr_mask, set_mask)
 
     elif clock_no == 0:
-        regs.CLKGP0CTL &= ctl
+        regs.modify('CLKGP0CTL', clr_mask, set_mask)
 
     elif clock_no == 1:
-        regs.CLKGP1CTL &= ctl
+        regs.modify('CLKGP1CTL', clr_mask, set_mask)
 
     elif clock_no == 2:
-        regs.CLKGP2CTL &= ctl
+        regs.modify('CLKGP2CTL', clr_mask, set_mask)
 
 
 def is_busy(clock_no):
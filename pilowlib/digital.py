@@ -18,9 +18,19 @@
 '''Sets or reads the digital value of a given GPIO pin.
 '''
 
-import funcs
-import regs
-import utils
+import array
+import time
+
+from pilowlib import funcs
+from pilowlib import regs
+from pilowlib import utils
+
+# the time to wait between the steps of the pull-up/down
+# configuration; the datasheet requires 150 cycles
+_PULL_DELAY_NS = 1000
+
+# the bits corresponding to all the GPIO pins
+_ALL_GPIOS_MASK = (1 << (funcs.MAX_GPIO + 1)) - 1
 
 
 def configure(gpio, pull):
@@ -43,7 +53,7 @@ def configure(gpio, pull):
     else: # None - disable pull
         regs.GPPUD = 0
 
-    utils.nanosleep(0, 5)
+    utils.delay_ns(_PULL_DELAY_NS)
 
     reg_no = gpio // 32
     bit_no = gpio % 32
@@ -54,11 +64,11 @@ def configure(gpio, pull):
     else:
         regs.GPPUDCLK1 = 1 << bit_no
 
-    utils.nanosleep(0, 5)
+    utils.delay_ns(_PULL_DELAY_NS)
 
     regs.GPPUD = 0
 
-    utils.nanosleep(0, 5)
+    utils.delay_ns(_PULL_DELAY_NS)
 
     if reg_no == 0:
         regs.GPPUDCLK0 = 0
@@ -66,7 +76,7 @@ def configure(gpio, pull):
     else:
         regs.GPPUDCLK1 = 0
 
-    utils.nanosleep(0, 5)
+    utils.delay_ns(_PULL_DELAY_NS)
 
 
 def set_value(gpio, value):
@@ -96,6 +106,56 @@ def set_value(gpio, value):
             regs.GPCLR1 = 1 << bit_no
 
 
+def write_mask(set_mask, clear_mask=0):
+    '''Sets and clears several GPIO pins at once, using
+    at most one write to each of the GPSET0, GPSET1,
+    GPCLR0 and GPCLR1 registers. Pins present in both masks
+    are set and then cleared.
+    @param set_mask: an integer with bit N set for each
+    GPIO pin N that should be set to 'high'
+    @param clear_mask: an integer with bit N set for each
+    GPIO pin N that should be set to 'low'
+    '''
+
+    if (set_mask | clear_mask) & ~_ALL_GPIOS_MASK:
+        raise Exception('Invalid GPIO mask')
+
+    if set_mask & 0xFFFFFFFF:
+        regs.GPSET0 = set_mask & 0xFFFFFFFF
+
+    if set_mask >> 32:
+        regs.GPSET1 = set_mask >> 32
+
+    if clear_mask & 0xFFFFFFFF:
+        regs.GPCLR0 = clear_mask & 0xFFFFFFFF
+
+    if clear_mask >> 32:
+        regs.GPCLR1 = clear_mask >> 32
+
+
+def write_pins(values):
+    '''Sets the digital values of several GPIO pins at once
+    (see write_mask()).
+    @param values: a dictionary associating a boolean
+    (the new pin value) to each GPIO pin number
+    '''
+
+    set_mask = 0
+    clear_mask = 0
+
+    for gpio, value in values.items():
+        if gpio < 0 or gpio > funcs.MAX_GPIO:
+            raise Exception('Invalid GPIO number')
+
+        if value:
+            set_mask |= 1 << gpio
+
+        else:
+            clear_mask |= 1 << gpio
+
+    write_mask(set_mask, clear_mask)
+
+
 def get_value(gpio):
     '''Reads and returns the digital value of a given
     GPIO pin.
@@ -113,3 +173,287 @@ def get_value(gpio):
 
     else:
         return bool(regs.GPLEV1 & (1 << bit_no))
+
+
+def read_all():
+    '''Reads the digital values of all the GPIO pins at once,
+    using one read of each of the GPLEV0 and GPLEV1 registers.
+    Returns an integer with bit N set for each
+    GPIO pin N that is 'high'.
+    '''
+
+    return (regs.GPLEV0 | (regs.GPLEV1 << 32)) & _ALL_GPIOS_MASK
+
+
+def read_pins(gpios):
+    '''Reads the digital values of several GPIO pins
+    from the same snapshot (see read_all()).
+    Returns a tuple of booleans, in the order of the given pins.
+    @param gpios: a sequence of GPIO pin numbers
+    '''
+
+    for gpio in gpios:
+        if gpio < 0 or gpio > funcs.MAX_GPIO:
+            raise Exception('Invalid GPIO number')
+
+    levels = read_all()
+
+    return tuple(bool(levels & (1 << gpio)) for gpio in gpios)
+
+
+def capture(pins_mask, n_samples, samples=None, timestamps=None,
+        interval=0, trigger_mask=0, trigger_value=0, timeout=None, clock=None):
+    '''Samples the levels of the GPIO pins in a tight loop
+    (logic analyzer mode). Only GPLEV0 is read, unless pins from
+    the second bank are requested, in which case GPLEV1 is read as well.
+    Returns a (samples, timestamps) tuple, where each sample is
+    an integer with the bits of the requested pins (as for read_all())
+    and each timestamp is the time of the sample in nanoseconds,
+    relative to the moment the capture was triggered.
+    @param pins_mask: an integer with bit N set for each
+    GPIO pin N that should be sampled
+    @param n_samples: the number of samples to capture
+    @param samples: a preallocated buffer for the samples
+    (e.g. an array('I') or a NumPy array) of at least n_samples items;
+    its items must be 64 bit wide (e.g. an array('Q'))
+    if pins of the second bank are sampled;
+    if None, a new array is created
+    @param timestamps: a preallocated buffer for the timestamps
+    (e.g. an array('Q') or a NumPy array) of at least n_samples items;
+    if None, a new array is created
+    @param interval: the minimum time between two samples,
+    in nanoseconds; 0 samples as fast as possible
+    @param trigger_mask: an integer with bit N set for each
+    GPIO pin N that is part of the trigger condition;
+    if 0, the capture starts immediately
+    @param trigger_value: the levels that the trigger pins must have
+    for the capture to start
+    @param timeout: the maximum time to wait for the trigger,
+    in seconds; if None, waits indefinitely
+    @param clock: a function returning the current time in nanoseconds,
+    used for the timestamps, the interval and the timeout; pass
+    systimer.ticks_ns to use the System Timer (1 us resolution);
+    if None, time.perf_counter_ns is used
+    '''
+
+    if (pins_mask | trigger_mask) & ~_ALL_GPIOS_MASK:
+        raise Exception('Invalid GPIO mask')
+
+    high_bank = (pins_mask | trigger_mask) >> 32
+
+    if samples is None:
+        samples = array.array('Q' if high_bank else 'I', bytes(8 * n_samples if high_bank else 4 * n_samples))
+
+    if timestamps is None:
+        timestamps = array.array('Q', bytes(8 * n_samples))
+
+    if len(samples) < n_samples or len(timestamps) < n_samples:
+        raise Exception('Capture buffer too small')
+
+    # the samples of the second bank do not fit 32 bit items
+    if pins_mask >> 32 and getattr(samples, 'itemsize', 8) < 8:
+        raise Exception('Capture buffer items too narrow')
+
+    words = regs.register('GPLEV0').mapped_words()
+    lev0 = regs.register('GPLEV0').index
+    lev1 = regs.register('GPLEV1').index
+    now = clock or time.perf_counter_ns
+
+    # wait for the trigger condition
+    if trigger_mask:
+        trigger_value &= trigger_mask
+        deadline = None
+        if timeout is not None:
+            deadline = now() + int(timeout * 1000000000)
+
+        while True:
+            if high_bank:
+                levels = words[lev0] | (words[lev1] << 32)
+
+            else:
+                levels = words[lev0]
+
+            if levels & trigger_mask == trigger_value:
+                break
+
+            if deadline is not None and now() > deadline:
+                raise Exception('Capture trigger timeout')
+
+    start = now()
+
+    if high_bank:
+        for i in range(n_samples):
+            samples[i] = (words[lev0] | (words[lev1] << 32)) & pins_mask
+            timestamps[i] = now() - start
+            if interval:
+                deadline = start + (i + 1) * interval
+                while now() < deadline:
+                    pass
+
+    else:
+        for i in range(n_samples):
+            samples[i] = words[lev0] & pins_mask
+            timestamps[i] = now() - start
+            if interval:
+                deadline = start + (i + 1) * interval
+                while now() < deadline:
+                    pass
+
+    return samples, timestamps
+
+
+class Pin(object):
+    '''A handle to a single GPIO pin, meant for time critical code.
+    The GPIO number is validated and the bank registers and bit mask
+    of the pin are resolved only once, when the handle is created,
+    so that each operation is a single register access.'''
+
+    __slots__ = ('gpio', 'mask', '_set_reg', '_clr_reg', '_lev_reg')
+
+    def __init__(self, gpio):
+        '''Creates a handle to a GPIO pin.
+        The pin function is not changed (see funcs.set_gpio_func()).
+        @param gpio: the number of the GPIO pin
+        '''
+
+        if gpio < 0 or gpio > funcs.MAX_GPIO:
+            raise Exception('Invalid GPIO number')
+
+        reg_no = gpio // 32
+        bit_no = gpio % 32
+
+        self.gpio = gpio
+        self.mask = 1 << bit_no
+        self._set_reg = regs.register('GPSET%d' % reg_no)
+        self._clr_reg = regs.register('GPCLR%d' % reg_no)
+        self._lev_reg = regs.register('GPLEV%d' % reg_no)
+
+    def high(self):
+        '''Sets the pin to 'high'.
+        '''
+
+        reg = self._set_reg
+        reg.words[reg.index] = self.mask
+
+    def low(self):
+        '''Sets the pin to 'low'.
+        '''
+
+        reg = self._clr_reg
+        reg.words[reg.index] = self.mask
+
+    def toggle(self):
+        '''Inverts the current level of the pin.
+        '''
+
+        reg = self._lev_reg
+        if reg.words[reg.index] & self.mask:
+            reg = self._clr_reg
+
+        else:
+            reg = self._set_reg
+
+        reg.words[reg.index] = self.mask
+
+    def read(self):
+        '''Reads and returns the digital value of the pin.
+        '''
+
+        reg = self._lev_reg
+
+        return bool(reg.words[reg.index] & self.mask)
+
+
+class Waveform(object):
+    '''A precompiled sequence of output steps, meant for
+    software-timed protocols (bit-banging). Each step sets and
+    clears a set of GPIO pins and is followed by a delay.
+    The steps are compiled into compact arrays holding only
+    the register writes that are actually needed, and the
+    timing of each step is computed in advance, relative to the
+    start of the playback, so that delays do not accumulate
+    errors. A waveform can be played any number of times.'''
+
+    def __init__(self, steps):
+        '''Compiles a waveform.
+        @param steps: a sequence of (set_mask, clear_mask, delay)
+        tuples, where the masks are as for write_mask() and
+        delay is the number of nanoseconds to wait before the next step
+        '''
+
+        set_indexes = (regs.register('GPSET0').index, regs.register('GPSET1').index)
+        clr_indexes = (regs.register('GPCLR0').index, regs.register('GPCLR1').index)
+
+        self.indexes = array.array('B') # the word index of each write
+        self.values = array.array('I') # the value of each write
+        self.ends = array.array('I') # the end of the writes of each step
+        self.times = array.array('Q') # the time of each step, in nanoseconds
+        self.duration = 0 # the total duration, in nanoseconds
+
+        for set_mask, clear_mask, delay in steps:
+            if (set_mask | clear_mask) & ~_ALL_GPIOS_MASK:
+                raise Exception('Invalid GPIO mask')
+
+            if delay < 0:
+                raise Exception('Invalid delay')
+
+            for indexes, mask in ((set_indexes, set_mask), (clr_indexes, clear_mask)):
+                if mask & 0xFFFFFFFF:
+                    self.indexes.append(indexes[0])
+                    self.values.append(mask & 0xFFFFFFFF)
+
+                if mask >> 32:
+                    self.indexes.append(indexes[1])
+                    self.values.append(mask >> 32)
+
+            self.ends.append(len(self.values))
+            self.times.append(self.duration)
+            self.duration += int(delay)
+
+    def __len__(self):
+        return len(self.times)
+
+    def play(self, count=1, clock=None):
+        '''Plays the waveform, busy-waiting between the steps.
+        Returns the maximum lateness of a step
+        with respect to its scheduled time, in nanoseconds.
+        @param count: the number of times to play the waveform
+        @param clock: a function returning the current time in nanoseconds,
+        against which the steps are timed; pass systimer.ticks_ns to use
+        the System Timer (1 us resolution); if None, time.perf_counter_ns
+        is used, which also works with the memory backend
+        '''
+
+        words = regs.register('GPSET0').mapped_words()
+        indexes = self.indexes
+        values = self.values
+        ends = self.ends
+        times = self.times
+        duration = self.duration
+        now = clock or time.perf_counter_ns
+        max_late = 0
+
+        start = now()
+        for _ in range(count):
+            j = 0
+            for i in range(len(times)):
+                deadline = start + times[i]
+                t = now()
+                while t < deadline:
+                    t = now()
+
+                end = ends[i]
+                while j < end:
+                    words[indexes[j]] = values[j]
+                    j += 1
+
+                if t - deadline > max_late:
+                    max_late = t - deadline
+
+            start += duration
+
+        # honor the delay of the last step
+        while now() < start:
+            pass
+
+        return max_late
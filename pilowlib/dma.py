@@ -0,0 +1,501 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides access to the DMA controller of the RPi (channels 0..14),
+allowing data to be moved between memory and the peripherals
+without any CPU intervention.
+A transfer is described by a chain of control blocks,
+placed in physically contiguous memory that is allocated
+from the VideoCore (see Memory). The SPI0 and PWM peripherals
+pace the transfers using their DREQ signals.
+Warning: some of the DMA channels are used by the system
+(e.g. for the SD card); using them here leads to data corruption.
+The channel numbers must therefore always be chosen explicitly.
+'''
+
+import ctypes
+import fcntl
+import mmap
+import os
+import struct
+import time
+
+from pilowlib import regs
+from pilowlib import spi
+
+# transfer information (TI) bits
+TI_INTEN = 1 << 0
+TI_TDMODE = 1 << 1
+TI_WAIT_RESP = 1 << 3
+TI_DEST_INC = 1 << 4
+TI_DEST_WIDTH = 1 << 5
+TI_DEST_DREQ = 1 << 6
+TI_DEST_IGNORE = 1 << 7
+TI_SRC_INC = 1 << 8
+TI_SRC_WIDTH = 1 << 9
+TI_SRC_DREQ = 1 << 10
+TI_SRC_IGNORE = 1 << 11
+TI_NO_WIDE_BURSTS = 1 << 26
+
+# peripherals that pace the transfers (see permap())
+PERMAP_NONE = 0
+PERMAP_PWM = 5
+PERMAP_SPI_TX = 6
+PERMAP_SPI_RX = 7
+
+CONTROL_BLOCK_SIZE = 32
+
+# channel CS bits
+_CS_ACTIVE = 1 << 0
+_CS_END = 1 << 1
+_CS_INT = 1 << 2
+_CS_ERROR = 1 << 8
+_CS_PRIORITY_SHIFT = 16
+_CS_PANIC_PRIORITY_SHIFT = 20
+_CS_WAIT_FOR_OUTSTANDING_WRITES = 1 << 28
+_CS_ABORT = 1 << 30
+_CS_RESET = 1 << 31
+
+_CONTROL_BLOCK_FORMAT = '<8I'
+_MAX_CHANNEL = 14
+
+# VideoCore mailbox
+_MBOX_DEVICE = '/dev/vcio'
+_MBOX_PROPERTY_IOCTL = (3 << 30) | (ctypes.sizeof(ctypes.c_void_p) << 16) | (100 << 8) | 0
+_MBOX_TAG_MEM_ALLOC = 0x3000C
+_MBOX_TAG_MEM_LOCK = 0x3000D
+_MBOX_TAG_MEM_UNLOCK = 0x3000E
+_MBOX_TAG_MEM_RELEASE = 0x3000F
+_MEM_FLAGS = 0x0C # direct, uncached allocation
+_BUS_ALIAS_MASK = 0xC0000000
+
+# the time between two checks while waiting for a channel, in seconds
+_WAIT_INTERVAL = 0.0001
+
+_SPI_MAX_LENGTH = 0xFFFF
+
+# PWMDMAC value enabling the DMA requests (panic and DREQ thresholds of 7)
+_PWM_DMAC_ENABLE = 0x80000707
+
+
+def permap(peripheral):
+    '''Returns the TI bits that select the peripheral
+    whose DREQ signal paces a transfer.
+    @param peripheral: one of the PERMAP_* constants
+    '''
+
+    return (peripheral & 0x1F) << 16
+
+
+class ControlBlock(object):
+    '''Describes a single DMA transfer. The addresses are
+    bus addresses (see Memory.bus_address and regs register
+    objects' bus_address). Control blocks do not touch the hardware
+    and can be freely built and inspected.'''
+
+    __slots__ = ('ti', 'source', 'dest', 'length', 'stride', 'next')
+
+    def __init__(self, ti, source, dest, length, stride=0, next=0):
+        '''Creates a control block.
+        @param ti: the transfer information (a combination of the TI_*
+        constants and permap())
+        @param source: the source bus address
+        @param dest: the destination bus address
+        @param length: the number of bytes to transfer
+        @param stride: the 2D mode strides (see the datasheet)
+        @param next: the bus address of the next control block, 0 to stop
+        '''
+
+        self.ti = ti
+        self.source = source
+        self.dest = dest
+        self.length = length
+        self.stride = stride
+        self.next = next
+
+    def pack(self):
+        '''Returns the control block in its hardware
+        representation (32 bytes).
+        '''
+
+        return struct.pack(_CONTROL_BLOCK_FORMAT, self.ti, self.source,
+                self.dest, self.length, self.stride, self.next, 0, 0)
+
+    def pack_into(self, buf, offs):
+        '''Writes the control block in its hardware representation
+        into a buffer.
+        @param buf: a writable buffer (e.g. Memory.mem)
+        @param offs: the offset in the buffer, a multiple of 32
+        '''
+
+        struct.pack_into(_CONTROL_BLOCK_FORMAT, buf, offs, self.ti, self.source,
+                self.dest, self.length, self.stride, self.next, 0, 0)
+
+    @classmethod
+    def unpack(cls, data, offs=0):
+        '''Creates a control block from its hardware representation.
+        @param data: the buffer holding the control block
+        @param offs: the offset of the control block in the buffer
+        '''
+
+        values = struct.unpack_from(_CONTROL_BLOCK_FORMAT, data, offs)
+
+        return cls(*values[:6])
+
+
+class Chain(object):
+    '''A sequence of control blocks executed one after the other.
+    The blocks are linked to each other when the chain is written
+    to memory, according to where it is placed. A looping chain
+    restarts from its first block after the last one, which allows
+    endless streams.'''
+
+    def __init__(self, blocks=(), loop=False):
+        '''Creates a chain of control blocks.
+        @param blocks: the initial control blocks
+        @param loop: set to True to link the last block to the first one
+        '''
+
+        self.blocks = list(blocks)
+        self.loop = loop
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def size(self):
+        '''The number of bytes occupied by the chain in memory.'''
+
+        return len(self.blocks) * CONTROL_BLOCK_SIZE
+
+    def append(self, block):
+        '''Adds a control block at the end of the chain.
+        @param block: the ControlBlock to add
+        '''
+
+        self.blocks.append(block)
+
+    def link(self, bus_address):
+        '''Sets the next address of each of the blocks, assuming
+        the chain is placed contiguously at the given bus address.
+        @param bus_address: the bus address of the first block,
+        a multiple of 32
+        '''
+
+        if bus_address % CONTROL_BLOCK_SIZE:
+            raise Exception('Unaligned control block address')
+
+        count = len(self.blocks)
+        for i, block in enumerate(self.blocks):
+            if i + 1 < count:
+                block.next = bus_address + (i + 1) * CONTROL_BLOCK_SIZE
+
+            elif self.loop:
+                block.next = bus_address
+
+            else:
+                block.next = 0
+
+    def pack_into(self, buf, offs, bus_address):
+        '''Links the chain (see link()) and writes it into a buffer.
+        Returns the bus address of the first block.
+        @param buf: a writable buffer (e.g. Memory.mem)
+        @param offs: the offset in the buffer, a multiple of 32
+        @param bus_address: the bus address corresponding to offs
+        '''
+
+        self.link(bus_address)
+        for i, block in enumerate(self.blocks):
+            block.pack_into(buf, offs + i * CONTROL_BLOCK_SIZE)
+
+        return bus_address
+
+
+class Memory(object):
+    '''A physically contiguous, uncached memory area allocated
+    from the VideoCore through its mailbox, suitable for
+    control blocks and DMA data. The area is mapped in the
+    process via /dev/mem; both require root access.'''
+
+    def __init__(self, size, flags=_MEM_FLAGS):
+        '''Allocates and maps memory.
+        @param size: the number of bytes to allocate
+        (rounded up to a multiple of the page size)
+        @param flags: the VideoCore allocation flags
+        '''
+
+        self.size = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        self.handle = None
+        self.bus_address = None
+        self.mem = None
+
+        self._mbox_fd = os.open(_MBOX_DEVICE, os.O_RDWR)
+
+        try:
+            self.handle = self._mbox_call(_MBOX_TAG_MEM_ALLOC, self.size, mmap.PAGESIZE, flags)
+            if not self.handle:
+                raise Exception('Could not allocate DMA memory')
+
+            self.bus_address = self._mbox_call(_MBOX_TAG_MEM_LOCK, self.handle)
+            if not self.bus_address:
+                raise Exception('Could not lock DMA memory')
+
+            dev_mem = os.open('/dev/mem', os.O_RDWR | os.O_SYNC)
+            try:
+                self.mem = mmap.mmap(
+                        dev_mem,
+                        length=self.size,
+                        flags=mmap.MAP_SHARED,
+                        prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                        offset=self.bus_address & ~_BUS_ALIAS_MASK)
+
+            finally:
+                os.close(dev_mem)
+
+        except BaseException:
+            self.close()
+            raise
+
+    def address_of(self, offs):
+        '''Returns the bus address of a given offset in the memory.
+        @param offs: the offset in the memory
+        '''
+
+        return self.bus_address + offs
+
+    def close(self):
+        '''Unmaps and releases the memory.
+        '''
+
+        if self.mem is not None:
+            self.mem.close()
+            self.mem = None
+
+        if self.bus_address:
+            self._mbox_call(_MBOX_TAG_MEM_UNLOCK, self.handle)
+            self.bus_address = None
+
+        if self.handle:
+            self._mbox_call(_MBOX_TAG_MEM_RELEASE, self.handle)
+            self.handle = None
+
+        if self._mbox_fd is not None:
+            os.close(self._mbox_fd)
+            self._mbox_fd = None
+
+    def _mbox_call(self, tag, *args):
+        # size, request code, tag, value buffer size, request size, values, end tag
+        values = list(args) + [0] * (3 - len(args))
+        message = struct.pack('<9I', 9 * 4, 0, tag, 12, 4 * len(args), *(values + [0]))
+        message = bytearray(message)
+        fcntl.ioctl(self._mbox_fd, _MBOX_PROPERTY_IOCTL, message)
+
+        return struct.unpack_from('<I', message, 20)[0]
+
+
+class Channel(object):
+    '''Controls one of the DMA channels (0..14).'''
+
+    def __init__(self, channel_no):
+        '''Creates a DMA channel controller.
+        @param channel_no: the number of the channel (0..14)
+        '''
+
+        if channel_no < 0 or channel_no > _MAX_CHANNEL:
+            raise Exception('Invalid DMA channel')
+
+        self.channel_no = channel_no
+        self._cs_reg = regs.register('DMA%dCS' % channel_no)
+        self._conblk_reg = regs.register('DMA%dCONBLKAD' % channel_no)
+        self._txfrlen_reg = regs.register('DMA%dTXFRLEN' % channel_no)
+
+    def reset(self):
+        '''Aborts any transfer and resets the channel,
+        making sure the channel is enabled in the DMA controller.
+        '''
+
+        regs.modify('DMAENABLE', 0, 1 << self.channel_no)
+
+        self._cs_reg.set(_CS_ABORT)
+        self._cs_reg.set(_CS_RESET)
+        self._cs_reg.set(_CS_INT | _CS_END)
+
+    def start(self, bus_address, priority=8, panic_priority=8):
+        '''Starts executing a chain of control blocks.
+        @param bus_address: the bus address of the first control block
+        (as returned by Chain.pack_into())
+        @param priority: the AXI priority of the transfers (0..15)
+        @param panic_priority: the AXI panic priority of the transfers (0..15)
+        '''
+
+        self.reset()
+
+        self._conblk_reg.set(bus_address)
+        self._cs_reg.set(_CS_ACTIVE | _CS_WAIT_FOR_OUTSTANDING_WRITES |
+                ((priority & 0xF) << _CS_PRIORITY_SHIFT) |
+                ((panic_priority & 0xF) << _CS_PANIC_PRIORITY_SHIFT))
+
+    def active(self):
+        '''Tells whether the channel is still transferring.
+        '''
+
+        return bool(self._cs_reg.get() & _CS_ACTIVE)
+
+    def error(self):
+        '''Tells whether the channel has encountered an error.
+        '''
+
+        return bool(self._cs_reg.get() & _CS_ERROR)
+
+    def remaining(self):
+        '''Returns the number of bytes left to transfer
+        by the current control block.
+        '''
+
+        return self._txfrlen_reg.get()
+
+    def wait(self, interval=_WAIT_INTERVAL):
+        '''Waits for the channel to finish transferring, sleeping
+        between checks. Never returns for looping chains.
+        @param interval: the time between two checks, in seconds
+        '''
+
+        while self._cs_reg.get() & _CS_ACTIVE:
+            time.sleep(interval)
+
+        if self.error():
+            raise Exception('DMA transfer error')
+
+
+def pwm_write(channel_no, values):
+    '''Feeds the PWM FIFO with a sequence of 32 bit values
+    using DMA, paced by the PWM DREQ, and waits for the transfer
+    to finish. The PWM peripheral must be configured to use
+    the FIFO (see pwm.configure()) and started.
+    @param channel_no: the number of the DMA channel to use
+    @param values: a sequence of 32 bit integers
+    (e.g. a list or an array('I'))
+    '''
+
+    length = 4 * len(values)
+    if not length:
+        return
+
+    channel = Channel(channel_no)
+    memory = Memory(CONTROL_BLOCK_SIZE + length)
+
+    try:
+        struct.pack_into('<%dI' % len(values), memory.mem, CONTROL_BLOCK_SIZE, *values)
+
+        chain = Chain([ControlBlock(
+                ti=TI_SRC_INC | TI_DEST_DREQ | TI_WAIT_RESP | permap(PERMAP_PWM),
+                source=memory.address_of(CONTROL_BLOCK_SIZE),
+                dest=regs.register('PWMFIF').bus_address,
+                length=length)])
+
+        address = chain.pack_into(memory.mem, 0, memory.address_of(0))
+
+        regs.PWMDMAC = _PWM_DMAC_ENABLE
+        channel.start(address)
+        try:
+            channel.wait()
+
+        finally:
+            channel.reset()
+            regs.PWMDMAC = 0
+
+    finally:
+        memory.close()
+
+
+def spi_transfer(tx_channel_no, rx_channel_no, data):
+    '''Writes and reads bytes to and from SPI0 using two DMA
+    channels, paced by the SPI DREQs, and waits for the transfer
+    to finish. The SPI must be configured beforehand (see spi.configure()).
+    Concurrent transfers are serialized with the other SPI0 functions
+    (see spi.Bus).
+    Returns the bytes that were read, as a bytearray.
+    @param tx_channel_no: the number of the DMA channel that feeds the SPI
+    @param rx_channel_no: the number of the DMA channel that drains the SPI
+    @param data: the bytes to write (at most 65535)
+    '''
+
+    data = memoryview(data).cast('B')
+    length = len(data)
+    if not length:
+        return bytearray()
+
+    if length > _SPI_MAX_LENGTH:
+        raise Exception('SPI DMA transfer too long')
+
+    with spi._lock:
+        return _spi_transfer(tx_channel_no, rx_channel_no, data, length)
+
+
+def _spi_transfer(tx_channel_no, rx_channel_no, data, length):
+    # the data is transferred in 32 bit words
+    words_length = (length + 3) // 4 * 4
+
+    tx_channel = Channel(tx_channel_no)
+    rx_channel = Channel(rx_channel_no)
+
+    # control blocks, then the TX words
+    # (preceded by the DLEN/CS word), then the RX words
+    tx_offs = 2 * CONTROL_BLOCK_SIZE
+    rx_offs = tx_offs + 4 + words_length
+    memory = Memory(rx_offs + words_length)
+
+    try:
+        cs = regs.SPI0CS & 0xFF & ~spi._CS_CLEAR
+        struct.pack_into('<I', memory.mem, tx_offs, (length << 16) | cs | spi._CS_TA)
+        memory.mem[tx_offs + 4:tx_offs + 4 + length] = data
+
+        fifo_address = regs.register('SPI0FIFO').bus_address
+        tx_chain = Chain([ControlBlock(
+                ti=TI_SRC_INC | TI_DEST_DREQ | TI_WAIT_RESP | permap(PERMAP_SPI_TX),
+                source=memory.address_of(tx_offs),
+                dest=fifo_address,
+                length=4 + words_length)])
+
+        rx_chain = Chain([ControlBlock(
+                ti=TI_DEST_INC | TI_SRC_DREQ | TI_WAIT_RESP | permap(PERMAP_SPI_RX),
+                source=fifo_address,
+                dest=memory.address_of(rx_offs),
+                length=words_length)])
+
+        tx_address = tx_chain.pack_into(memory.mem, 0, memory.address_of(0))
+        rx_address = rx_chain.pack_into(memory.mem, CONTROL_BLOCK_SIZE,
+                memory.address_of(CONTROL_BLOCK_SIZE))
+
+        # clear the fifos and let the SPI issue DMA requests,
+        # deasserting the chip select automatically at the end
+        regs.modify('SPI0CS', spi._CS_TA, spi._CS_CLEAR | spi._CS_DMAEN | spi._CS_ADCS)
+
+        rx_channel.start(rx_address)
+        tx_channel.start(tx_address)
+        try:
+            rx_channel.wait()
+
+        finally:
+            tx_channel.reset()
+            rx_channel.reset()
+            regs.modify('SPI0CS', spi._CS_TA | spi._CS_DMAEN | spi._CS_ADCS, 0)
+
+        return bytearray(memory.mem[rx_offs:rx_offs + length])
+
+    finally:
+        memory.close()
@@ -0,0 +1,252 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides hardware edge and level detection for the GPIO pins.
+The detected events are latched by the GPIO peripheral in the
+GPEDS registers until they are cleared, so short pulses are
+not lost between two polls. A single Poller can watch all the pins.
+'''
+
+import threading
+import time
+
+from pilowlib import digital
+from pilowlib import funcs
+from pilowlib import regs
+
+# detected events
+RISING = 0x01 # rising edge, synchronized to the system clock
+FALLING = 0x02 # falling edge, synchronized to the system clock
+BOTH = RISING | FALLING
+HIGH = 0x04 # high level
+LOW = 0x08 # low level
+ASYNC_RISING = 0x10 # rising edge, not synchronized (detects very short pulses)
+ASYNC_FALLING = 0x20 # falling edge, not synchronized (detects very short pulses)
+
+# the detect enable registers (for the two banks)
+# corresponding to each of the events
+_enable_regs = [
+    (RISING, 'GPREN'),
+    (FALLING, 'GPFEN'),
+    (HIGH, 'GPHEN'),
+    (LOW, 'GPLEN'),
+    (ASYNC_RISING, 'GPAREN'),
+    (ASYNC_FALLING, 'GPAFEN'),
+]
+
+
+def enable(gpio, events=BOTH):
+    '''Enables the detection of the given events for a GPIO pin.
+    Any events previously enabled for the pin are replaced.
+    @param gpio: the number of the GPIO pin
+    @param events: a combination of the RISING, FALLING, HIGH, LOW,
+    ASYNC_RISING and ASYNC_FALLING constants
+    '''
+
+    if gpio < 0 or gpio > funcs.MAX_GPIO:
+        raise Exception('Invalid GPIO number')
+
+    reg_no = gpio // 32
+    mask = 1 << (gpio % 32)
+
+    for event, name in _enable_regs:
+        if events & event:
+            regs.modify('%s%d' % (name, reg_no), 0, mask)
+
+        else:
+            regs.modify('%s%d' % (name, reg_no), mask, 0)
+
+    # discard any event latched before enabling
+    if reg_no == 0:
+        regs.GPEDS0 = mask
+
+    else:
+        regs.GPEDS1 = mask
+
+
+def enabled(gpio):
+    '''Returns the events whose detection is enabled for a GPIO pin,
+    as a combination of the event constants.
+    @param gpio: the number of the GPIO pin
+    '''
+
+    if gpio < 0 or gpio > funcs.MAX_GPIO:
+        raise Exception('Invalid GPIO number')
+
+    reg_no = gpio // 32
+    mask = 1 << (gpio % 32)
+
+    events = 0
+    for event, name in _enable_regs:
+        if regs.register('%s%d' % (name, reg_no)).get() & mask:
+            events |= event
+
+    return events
+
+
+def disable(gpio):
+    '''Disables the detection of all the events for a GPIO pin.
+    @param gpio: the number of the GPIO pin
+    '''
+
+    enable(gpio, 0)
+
+
+def pending():
+    '''Returns the pins that have latched events, without
+    clearing them, as an integer with bit N set for each GPIO pin N.
+    '''
+
+    return (regs.GPEDS0 | (regs.GPEDS1 << 32)) & digital._ALL_GPIOS_MASK
+
+
+def drain():
+    '''Returns and clears the pins that have latched events,
+    as an integer with bit N set for each GPIO pin N.
+    Uses one read and at most one write for each of the two banks,
+    clearing only the events that were read.
+    '''
+
+    status0 = regs.GPEDS0
+    if status0:
+        regs.GPEDS0 = status0
+
+    status1 = regs.GPEDS1
+    if status1:
+        regs.GPEDS1 = status1
+
+    return (status0 | (status1 << 32)) & digital._ALL_GPIOS_MASK
+
+
+class Poller(object):
+    '''Watches all the GPIO pins for latched events from
+    a single background thread. Each time events are drained,
+    the callback registered for each pin is called and/or the event
+    is put in a queue, as a (gpio, level, timestamp) tuple,
+    where level is the level of the pin right after draining
+    (not necessarily the direction of the edge, which may have been
+    followed by others) and timestamp is the time.monotonic()
+    of the drain, in seconds (comparable to the timestamps
+    of gpiochip.Poller).'''
+
+    def __init__(self, interval=0.001, queue=None):
+        '''Creates an event poller.
+        @param interval: the time between two polls, in seconds
+        @param queue: an object with a put() method (e.g. a queue.Queue)
+        that receives all the events; if None, only the callbacks are used
+        '''
+
+        self.interval = interval
+        self.queue = queue
+        self.callbacks = {}
+
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._error = None # the exception that ended the background thread
+
+    def add_callback(self, gpio, callback, events=None):
+        '''Registers the function to be called when
+        events are detected for a GPIO pin.
+        @param gpio: the number of the GPIO pin
+        @param callback: a function accepting (gpio, level, timestamp)
+        @param events: if not None, the events to enable for the pin
+        (see enable())
+        '''
+
+        if gpio < 0 or gpio > funcs.MAX_GPIO:
+            raise Exception('Invalid GPIO number')
+
+        if events is not None:
+            enable(gpio, events)
+
+        self.callbacks[gpio] = callback
+
+    def remove_callback(self, gpio):
+        '''Unregisters the callback of a GPIO pin.
+        @param gpio: the number of the GPIO pin
+        '''
+
+        self.callbacks.pop(gpio, None)
+
+    def poll(self):
+        '''Drains the latched events and dispatches them.
+        Returns the pins that had events (see drain()).
+        This is called periodically by the background thread,
+        but can also be called directly, without starting the thread.
+        '''
+
+        status = drain()
+        if not status:
+            return 0
+
+        levels = digital.read_all()
+        timestamp = time.monotonic()
+
+        gpio = 0
+        remaining = status
+        while remaining:
+            if remaining & 1:
+                level = bool(levels & (1 << gpio))
+                callback = self.callbacks.get(gpio)
+                if callback is not None:
+                    callback(gpio, level, timestamp)
+
+                if self.queue is not None:
+                    self.queue.put((gpio, level, timestamp))
+
+            remaining >>= 1
+            gpio += 1
+
+        return status
+
+    def start(self):
+        '''Starts the background polling thread.
+        '''
+
+        if self._thread is not None:
+            raise Exception('Poller already started')
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the background polling thread
+        and waits for it to finish. If a callback raised an exception,
+        which ended the thread, the exception is raised here.
+        '''
+
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        try:
+            while not self._stop_event.wait(self.interval):
+                self.poll()
+
+        except Exception as e:
+            # the thread ends, the exception is raised by stop()
+            self._error = e
@@ -19,7 +19,7 @@
 available for each of the GPIO pins of the RPi.
 '''
 
-import regs
+from pilowlib import regs
 
 # GPIO digital I/O
 DIGITAL_IN = 0
@@ -255,21 +255,40 @@ _gpio_accessible = [
     False, # GPIO PIN 53
 ]
 
+# the function select bits for each
+# of the available (gpio, function) pairs
+_gpio_func_bits = {}
+
+# the GPIO pins on which each of the functions is available
+_func_gpios = {}
+
+# the function select registers, each of them
+# configuring 10 consecutive GPIO pins
+_gpfsel_regs = [
+    regs.register('GPFSEL0'),
+    regs.register('GPFSEL1'),
+    regs.register('GPFSEL2'),
+    regs.register('GPFSEL3'),
+    regs.register('GPFSEL4'),
+    regs.register('GPFSEL5'),
+]
 
-def _find_func_index(gpio, func):
-    '''Returns the index in the 8 functions array
-    for the given function. If the function is not available,
-    -1 is returned.
-    @param gpio: the number of the GPIO pin
-    @param func: the desired function
-    '''
-    
-    functions = _functions[gpio]
-    for i in xrange(len(functions)):
-        if functions[i] == func:
-            return i
 
-    return -1
+def _build_func_indexes():
+    '''Builds the function lookup indexes
+    out of the _functions table.'''
+
+    func_gpios = {}
+    for gpio, functions in enumerate(_functions):
+        for func_index, func in enumerate(functions):
+            if func is None or (gpio, func) in _gpio_func_bits:
+                continue
+
+            _gpio_func_bits[(gpio, func)] = _func_bits[func_index]
+            func_gpios.setdefault(func, []).append(gpio)
+
+    for func, gpios in func_gpios.items():
+        _func_gpios[func] = tuple(gpios)
 
 
 def func_available(gpio, func):
@@ -285,7 +304,19 @@ def func_available(gpio, func):
     if gpio < 0 or gpio > MAX_GPIO:
         raise Exception('Invalid GPIO number')
 
-    return _find_func_index(gpio, func) >= 0
+    return (gpio, func) in _gpio_func_bits
+
+
+def pins_for(func):
+    '''Returns the GPIO pins on which a given
+    function is available, as a tuple of GPIO numbers.
+    @param func: the desired function
+    '''
+
+    if func < 0 or func > MAX_FUNC:
+        raise Exception('Invalid function')
+
+    return _func_gpios.get(func, ())
 
 
 def gpio_accessible(gpio):
@@ -300,13 +331,14 @@ def gpio_accessible(gpio):
     return _gpio_accessible[gpio]
 
 
-def set_gpio_func(gpio, func):
-    '''Sets the alternative function of the given
-    GPIO pin.
+def _gpio_func_masks(gpio, func):
+    '''Returns the function select register number,
+    the clear mask and the set mask that configure
+    the given function on a GPIO pin.
     @param gpio: the number of the GPIO pin
     @param func: the desired function
     '''
-    
+
     if func < 0 or func > MAX_FUNC:
         raise Exception('Invalid GPIO number')
 
@@ -316,35 +348,72 @@ def set_gpio_func(gpio, func):
     gpfsel_no = gpio // 10
     gpf_bit_start = (gpio % 10) * 3
 
-    func_index = _find_func_index(gpio, func)
-    if func_index == -1:
+    func_bits = _gpio_func_bits.get((gpio, func))
+    if func_bits is None:
         raise Exception('Function not available on GPIO pin')
 
-    func_bits = _func_bits[func_index]
+    clr_mask = 0x7 << gpf_bit_start
+    set_mask = func_bits << gpf_bit_start
+
+    return gpfsel_no, clr_mask, set_mask
+
+
+def set_gpio_func(gpio, func):
+    '''Sets the alternative function of the given
+    GPIO pin.
+    @param gpio: the number of the GPIO pin
+    @param func: the desired function
+    '''
+
+    gpfsel_no, clr_mask, set_mask = _gpio_func_masks(gpio, func)
+
+    regs.modify(_gpfsel_regs[gpfsel_no], clr_mask, set_mask)
+
+
+def set_gpio_funcs(functions):
+    '''Sets the alternative functions of several GPIO pins
+    at once, with at most one read and one write for
+    each of the function select registers involved.
+    @param functions: a dictionary associating the desired function
+    to each GPIO pin number
+    '''
+
+    PinMuxProfile(functions).apply()
+
+
+class PinMuxProfile(object):
+    '''A precompiled configuration of the alternative functions
+    of several GPIO pins. The pins are grouped by their
+    function select register, so that applying the profile
+    costs at most one read and one write for each
+    register involved. Profiles are meant to be created once
+    and applied whenever needed.'''
 
-    clr_value = ~(0x7 << gpf_bit_start)
-    set_value = (func_bits << gpf_bit_start)
+    def __init__(self, functions):
+        '''Compiles a pin mux profile.
+        @param functions: a dictionary associating the desired function
+        to each GPIO pin number
+        '''
 
-    if gpfsel_no == 0:
-        regs.GPFSEL0 &= clr_value
-        regs.GPFSEL0 |= set_value
+        masks = {}
+        for gpio, func in functions.items():
+            gpfsel_no, clr_mask, set_mask = _gpio_func_masks(gpio, func)
+            old_clr_mask, old_set_mask = masks.get(gpfsel_no, (0, 0))
+            masks[gpfsel_no] = (old_clr_mask | clr_mask, old_set_mask | set_mask)
 
-    elif gpfsel_no == 1:
-        regs.GPFSEL1 &= clr_value
-        regs.GPFSEL1 |= set_value
+        self.functions = dict(functions)
+        self.writes = tuple((_gpfsel_regs[gpfsel_no], clr_mask, set_mask)
+                for gpfsel_no, (clr_mask, set_mask) in sorted(masks.items()))
 
-    elif gpfsel_no == 2:
-        regs.GPFSEL2 &= clr_value
-        regs.GPFSEL2 |= set_value
+    def apply(self):
+        '''Configures the GPIO pins according to this profile.
+        '''
 
-    elif gpfsel_no == 3:
-        regs.GPFSEL3 &= clr_value
-        regs.GPFSEL3 |= set_value
+        modify = regs.modify
+        for reg, clr_mask, set_mask in self.writes:
+            modify(reg, clr_mask, set_mask)
 
-    elif gpfsel_no == 4:
-        regs.GPFSEL4 &= clr_value
-        regs.GPFSEL4 |= set_value
 
-    elif gpfsel_no == 5:
-        regs.GPFSEL5 &= clr_value
-        regs.GPFSEL5 |= set_value
+# build the function lookup indexes as soon as
+# the module is imported for the first time
+_build_func_indexes()
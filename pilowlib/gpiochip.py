@@ -0,0 +1,322 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides GPIO edge events delivered by the kernel, through
+the Linux GPIO character device (/dev/gpiochipN, uAPI v2).
+Unlike the events module, which polls the GPEDS registers,
+waiting for events here blocks in the kernel and uses no CPU.
+The pins are identified by their GPIO numbers, which are
+the line offsets of the chip (as is the case for gpiochip0 on the RPi),
+and they can still be read using the digital module.
+This module does not access the peripherals memory at all,
+so it can be used with the gpio-sim kernel module on any machine.
+'''
+
+import ctypes
+import fcntl
+import os
+import select
+import struct
+import threading
+
+from pilowlib import events
+from pilowlib import funcs
+
+_DEFAULT_CHIP = '/dev/gpiochip0'
+
+# line request flags
+_LINE_FLAG_INPUT = 1 << 2
+_LINE_FLAG_EDGE_RISING = 1 << 4
+_LINE_FLAG_EDGE_FALLING = 1 << 5
+_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+_LINE_FLAG_BIAS_PULL_DOWN = 1 << 9
+_LINE_FLAG_BIAS_DISABLED = 1 << 10
+
+_LINE_ATTR_ID_DEBOUNCE = 3
+
+# line event ids
+_LINE_EVENT_RISING_EDGE = 1
+_LINE_EVENT_FALLING_EDGE = 2
+
+_LINE_EVENT_FORMAT = 'QIIII24x' # struct gpio_v2_line_event
+_LINE_EVENT_SIZE = struct.calcsize(_LINE_EVENT_FORMAT)
+_LINE_EVENTS_READ = 16 # the number of events read at once
+
+
+class _LineAttribute(ctypes.Structure):
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('padding', ctypes.c_uint32),
+        ('value', ctypes.c_uint64), # flags, values or debounce_period_us
+    ]
+
+
+class _LineConfigAttribute(ctypes.Structure):
+    _fields_ = [
+        ('attr', _LineAttribute),
+        ('mask', ctypes.c_uint64),
+    ]
+
+
+class _LineConfig(ctypes.Structure):
+    _fields_ = [
+        ('flags', ctypes.c_uint64),
+        ('num_attrs', ctypes.c_uint32),
+        ('padding', ctypes.c_uint32 * 5),
+        ('attrs', _LineConfigAttribute * 10),
+    ]
+
+
+class _LineRequest(ctypes.Structure):
+    _fields_ = [
+        ('offsets', ctypes.c_uint32 * 64),
+        ('consumer', ctypes.c_char * 32),
+        ('config', _LineConfig),
+        ('num_lines', ctypes.c_uint32),
+        ('event_buffer_size', ctypes.c_uint32),
+        ('padding', ctypes.c_uint32 * 5),
+        ('fd', ctypes.c_int32),
+    ]
+
+
+# _IOWR(0xB4, 0x07, struct gpio_v2_line_request)
+_GET_LINE_IOCTL = (3 << 30) | (ctypes.sizeof(_LineRequest) << 16) | (0xB4 << 8) | 0x07
+
+
+class Poller(object):
+    '''Waits for kernel-delivered edge events on several GPIO pins.
+    Each pin is requested as an input line with edge detection,
+    and all the line file descriptors are watched with a single epoll.
+    The events are dispatched like by events.Poller:
+    to the callback registered for each pin and/or to a queue,
+    as (gpio, level, timestamp) tuples. Unlike with events.Poller,
+    every edge is reported, level is the direction of the edge
+    (True for a rising edge) rather than the level read afterwards,
+    and timestamp is the kernel time of the edge, in seconds
+    (comparable to time.monotonic()).'''
+
+    def __init__(self, chip=_DEFAULT_CHIP, queue=None, consumer='pilowlib'):
+        '''Creates a GPIO character device poller.
+        @param chip: the path of the GPIO character device
+        @param queue: an object with a put() method (e.g. a queue.Queue)
+        that receives all the events; if None, only the callbacks are used
+        @param consumer: the consumer label shown by the kernel for
+        the requested lines
+        '''
+
+        self.chip = chip
+        self.queue = queue
+        self.consumer = consumer
+        self.callbacks = {}
+
+        self._chip_fd = None
+        self._lock = threading.Lock() # protects the line fds against the poll() thread
+        self._line_fds = {} # the line request fd of each GPIO pin
+        self._fd_gpios = {} # the GPIO pin of each line request fd
+        self._epoll = select.epoll()
+        self._wake_r, self._wake_w = os.pipe()
+        self._epoll.register(self._wake_r, select.EPOLLIN)
+        self._thread = None
+        self._stop = False
+        self._error = None # the exception that ended the background thread
+
+    def add_callback(self, gpio, callback, edges=events.BOTH, pull=None, debounce_us=0):
+        '''Requests edge events for a GPIO pin and registers the
+        function to be called when they occur. The pin is configured
+        as an input by the kernel.
+        @param gpio: the number of the GPIO pin
+        @param callback: a function accepting (gpio, level, timestamp),
+        or None if only the queue should receive the events
+        @param edges: events.RISING, events.FALLING or events.BOTH
+        @param pull: set to True to enable pull-up,
+        False to enable pull-down, or None to leave the bias unchanged
+        @param debounce_us: the debounce period, in microseconds (0 disables it)
+        '''
+
+        if gpio < 0 or gpio > funcs.MAX_GPIO:
+            raise Exception('Invalid GPIO number')
+
+        if not edges & events.BOTH or edges & ~events.BOTH:
+            raise Exception('Invalid edges')
+
+        self.remove_callback(gpio)
+
+        flags = _LINE_FLAG_INPUT
+        if edges & events.RISING:
+            flags |= _LINE_FLAG_EDGE_RISING
+
+        if edges & events.FALLING:
+            flags |= _LINE_FLAG_EDGE_FALLING
+
+        if pull:
+            flags |= _LINE_FLAG_BIAS_PULL_UP
+
+        elif pull is False:
+            flags |= _LINE_FLAG_BIAS_PULL_DOWN
+
+        request = _LineRequest()
+        request.offsets[0] = gpio
+        request.num_lines = 1
+        request.consumer = self.consumer.encode()[:31]
+        request.config.flags = flags
+        if debounce_us:
+            request.config.num_attrs = 1
+            request.config.attrs[0].attr.id = _LINE_ATTR_ID_DEBOUNCE
+            request.config.attrs[0].attr.value = debounce_us
+            request.config.attrs[0].mask = 1
+
+        with self._lock:
+            if self._chip_fd is None:
+                self._chip_fd = os.open(self.chip, os.O_RDWR | os.O_CLOEXEC)
+
+            fcntl.ioctl(self._chip_fd, _GET_LINE_IOCTL, request)
+
+            # a fd reported by a poll() that was running while the line
+            # was added may refer to a line without events, so never block
+            os.set_blocking(request.fd, False)
+
+            self._line_fds[gpio] = request.fd
+            self._fd_gpios[request.fd] = gpio
+            self.callbacks[gpio] = callback
+            self._epoll.register(request.fd, select.EPOLLIN)
+
+    def remove_callback(self, gpio):
+        '''Releases the line of a GPIO pin and unregisters its callback.
+        This can be done while the background thread is running.
+        @param gpio: the number of the GPIO pin
+        '''
+
+        with self._lock:
+            fd = self._line_fds.pop(gpio, None)
+            if fd is None:
+                return
+
+            self._epoll.unregister(fd)
+            del self._fd_gpios[fd]
+            del self.callbacks[gpio]
+            os.close(fd)
+
+    def poll(self, timeout=None):
+        '''Waits for edge events and dispatches them.
+        Returns the number of dispatched events.
+        This is called repeatedly by the background thread,
+        but can also be called directly, without starting the thread.
+        @param timeout: the maximum time to wait, in seconds;
+        if None, waits until at least one event occurs
+        '''
+
+        ready = self._epoll.poll(-1 if timeout is None else timeout)
+
+        # the lines may be released in the meantime, so the fds
+        # are only read while they are known to be open
+        reads = []
+        with self._lock:
+            for fd, mask in ready:
+                gpio = self._fd_gpios.get(fd)
+                if gpio is None: # the wake-up pipe or a released line
+                    continue
+
+                try:
+                    data = os.read(fd, _LINE_EVENT_SIZE * _LINE_EVENTS_READ)
+
+                except BlockingIOError:
+                    continue
+
+                reads.append((gpio, self.callbacks.get(gpio), data))
+
+        # the callbacks are called without holding the lock,
+        # so that they can add and remove callbacks themselves
+        count = 0
+        for gpio, callback, data in reads:
+            for offs in range(0, len(data), _LINE_EVENT_SIZE):
+                timestamp_ns, event_id, line, seqno, line_seqno = struct.unpack_from(
+                        _LINE_EVENT_FORMAT, data, offs)
+
+                level = event_id == _LINE_EVENT_RISING_EDGE
+                timestamp = timestamp_ns / 1000000000.0
+
+                if callback is not None:
+                    callback(gpio, level, timestamp)
+
+                if self.queue is not None:
+                    self.queue.put((gpio, level, timestamp))
+
+                count += 1
+
+        return count
+
+    def start(self):
+        '''Starts the background thread that waits for the events.
+        '''
+
+        if self._thread is not None:
+            raise Exception('Poller already started')
+
+        self._stop = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the background thread and waits for it to finish.
+        If a callback raised an exception, which ended the thread,
+        the exception is raised here.
+        '''
+
+        if self._thread is None:
+            return
+
+        self._stop = True
+        os.write(self._wake_w, b'\0')
+        self._thread.join()
+        self._thread = None
+        os.read(self._wake_r, 1)
+
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        '''Stops the background thread and releases all
+        the requested lines, as well as the GPIO character device.
+        The exception that ended the thread, if any, is raised
+        once everything is released (see stop()).
+        '''
+
+        try:
+            self.stop()
+
+        finally:
+            for gpio in list(self._line_fds):
+                self.remove_callback(gpio)
+
+            if self._chip_fd is not None:
+                os.close(self._chip_fd)
+                self._chip_fd = None
+
+            self._epoll.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+
+    def _run(self):
+        try:
+            while not self._stop:
+                self.poll()
+
+        except Exception as e:
+            # the thread ends, the exception is raised by stop()
+            self._error = e
@@ -20,8 +20,49 @@ PWM peripherals of the RPi.
 There are two PWM peripherals numbered 0 and 1.
 '''
 
-import clock
-import regs
+import array
+import sys
+import threading
+import time
+
+from pilowlib import clock
+from pilowlib import dma
+from pilowlib import regs
+
+# PWMSTA bits
+_STA_FULL = 0x01
+_STA_WERR = 0x04
+_STA_RERR = 0x08
+_STA_GAPO = 0x30
+_STA_ERRORS = _STA_WERR | _STA_RERR | _STA_GAPO
+
+_INT_FORMATS = 'bBhHiIlLqQ' # the buffer formats that can be written to the FIFO
+_STREAM_INTERVAL = 0.0001 # the time a stream sleeps when the FIFO is full, in seconds
+
+# the clock sources considered by set_frequency(), along with their
+# frequencies; the other PLLs change with the system configuration
+# and are not used
+_FREQ_SOURCES = [
+    (clock.SRC_OSC, 19200000),
+    (clock.SRC_PLLD, 500000000),
+]
+_FREQ_MIN_DIV = 2
+_FREQ_MAX_DIV = 0xFFF
+_FREQ_MAX_RANGE = 0xFFFFFFFF
+
+_freq_solutions = {} # the (src, div, range) solution of each frequency
+_freq_ranges = [None, None] # the range set by set_frequency() for each PWM
+
+# LED strip (WS2812) timings
+_LED_BIT_RATE = 800000 # the LED data bits per second
+_LED_SYMBOLS = { # the serializer symbols of a 0 and a 1 data bit
+    3: (0x4, 0x6), # 100, 110
+    4: (0x8, 0xE), # 1000, 1110
+}
+
+_dat_regs = [regs.register('PWMDAT0'), regs.register('PWMDAT1')]
+_sta_reg = regs.register('PWMSTA')
+_fif_reg = regs.register('PWMFIF')
 
 
 def configure(pwm_no, serial_mode=False, ms_mode=False, use_fifo=False, rep_fifo=False, high_off=False, rev_polarity=False):
@@ -60,14 +101,10 @@ def configure(pwm_no, serial_mode=False, ms_mode=False, use_fifo=False, rep_fifo
         value |= 0x10
 
     if pwm_no == 0:
-        regs.PWMCTL &= ~0xFF;
-        regs.PWMCTL |= value
+        regs.modify('PWMCTL', 0xFF, value)
 
     elif pwm_no == 1:
-        value <<= 8
-
-        regs.PWMCTL &= ~0xFF00;
-        regs.PWMCTL |= value
+        regs.modify('PWMCTL', 0xFF00, value << 8)
 
     else:
         raise Exception('Invalid PWM number')
@@ -124,10 +161,10 @@ def start(pwm_no):
     '''
     
     if pwm_no == 0:
-        regs.PWMCTL |= 0x01
+        regs.modify('PWMCTL', 0, 0x01)
 
     elif pwm_no == 1:
-        regs.PWMCTL |= 0x100
+        regs.modify('PWMCTL', 0, 0x100)
 
     else:
         raise Exception('Invalid PWM number')
@@ -143,10 +180,10 @@ def stop(pwm_no):
     '''
     
     if pwm_no == 0:
-        regs.PWMCTL &= ~0x01
+        regs.modify('PWMCTL', 0x01, 0)
 
     elif pwm_no == 1:
-        regs.PWMCTL &= ~0x100
+        regs.modify('PWMCTL', 0x100, 0)
 
     else:
         raise Exception('Invalid PWM number')
@@ -164,7 +201,7 @@ def clear_fifo():
     '''Clears the PWM FIFO.
     '''
     
-    regs.PWMCTL &= 0x40
+    regs.modify('PWMCTL', 0, 0x40)
 
 
 def fifo_full():
@@ -179,3 +216,455 @@ def fifo_empty():
     '''
     
     return regs.PWMSTA & 0x02
+
+
+def set_frequency(pwm_no, hz, duty):
+    '''Sets the output frequency and the duty cycle of a PWM peripheral,
+    choosing the clock source, the clock divider and the range that give
+    the closest frequency and, among those, the finest duty resolution.
+    The solutions are cached, so that going back to a frequency
+    does not search again. The PWM is switched to the M/S mode,
+    since only in this mode the period is exactly range clock cycles,
+    and to the data register (the serializer, the FIFO and the reversed
+    polarity set by configure() are turned off).
+    Warning: the PWM clock is shared by both PWM peripherals, therefore
+    changing the clock also changes the frequency of the other one.
+    Returns the actual frequency.
+    @param pwm_no: the identifier of the PWM (0 or 1)
+    @param hz: the output frequency, in Hz
+    @param duty: the duty cycle (between 0 and 1)
+    '''
+
+    if pwm_no not in (0, 1):
+        raise Exception('Invalid PWM number')
+
+    if duty < 0 or duty > 1:
+        raise Exception('Invalid duty cycle')
+
+    solution = _freq_solutions.get(hz)
+    if solution is None:
+        solution = _freq_solutions[hz] = _solve_frequency(hz)
+
+    src, div, range = solution
+
+    # the clock is reconfigured only when needed, as this disturbs the outputs;
+    # its current configuration is read back, since it may have been
+    # changed by other means (e.g. configure_clock())
+    if regs.CLKPWMCTL & 0x1F != 0x10 | src or (regs.CLKPWMDIV >> 12) & 0xFFF != div:
+        clock.stop('pwm')
+        while clock.is_busy('pwm'):
+            pass
+
+        configure_clock(src, div)
+        clock.start('pwm')
+
+    # switch to M/S mode, taking the data from the data register,
+    # with the normal polarity; the enable bit is left untouched
+    shift = 8 * pwm_no
+    regs.modify('PWMCTL', 0x7E << shift, 0x80 << shift)
+
+    set_range(pwm_no, range)
+    _freq_ranges[pwm_no] = range
+    set_duty(pwm_no, duty)
+
+    return dict(_FREQ_SOURCES)[src] / float(div * range)
+
+
+def set_duty(pwm_no, duty):
+    '''Changes the duty cycle of a PWM peripheral whose frequency
+    was set by set_frequency(). This only writes the data register.
+    @param pwm_no: the identifier of the PWM (0 or 1)
+    @param duty: the duty cycle (between 0 and 1)
+    '''
+
+    if pwm_no not in (0, 1):
+        raise Exception('Invalid PWM number')
+
+    if duty < 0 or duty > 1:
+        raise Exception('Invalid duty cycle')
+
+    range = _freq_ranges[pwm_no]
+    if range is None:
+        raise Exception('PWM frequency not set')
+
+    dat = _dat_regs[pwm_no]
+    dat.words[dat.index] = int(duty * range + 0.5)
+
+
+def _solve_frequency(hz):
+    '''Returns the (src, div, range) combination that gives the
+    frequency closest to hz, with the largest range.'''
+
+    if hz <= 0:
+        raise Exception('Invalid frequency')
+
+    best = None
+    best_key = None
+    for src, src_hz in _FREQ_SOURCES:
+        for div in range(_FREQ_MIN_DIV, _FREQ_MAX_DIV + 1):
+            rng = int(src_hz / float(div) / hz + 0.5)
+            if rng < 2 or rng > _FREQ_MAX_RANGE:
+                continue
+
+            # compare the errors with a relative precision of 1e-9
+            error = round(abs(src_hz / float(div * rng) - hz) / hz, 9)
+            key = (error, -rng)
+            if best_key is None or key < best_key:
+                best = (src, div, rng)
+                best_key = key
+
+    if best is None:
+        raise Exception('Frequency out of range')
+
+    return best
+
+
+class Stream(object):
+    '''Keeps the PWM FIFO topped up from a background thread.
+    The data comes from sources (iterables of integers, arrays,
+    NumPy arrays or any other 1-dimensional buffer) that are written
+    one after the other. While a source is being written, the next one
+    can already be queued with feed(), so that the output continues
+    without a gap (double buffering).
+    The PWM peripheral(s) must be configured to use the FIFO.
+    The underruns attribute counts the wake-ups that found that the FIFO
+    had run empty while data was still available (PWMSTA RERR1/GAPO flags),
+    and the overruns attribute counts the wake-ups that found that
+    a value was written to the full FIFO (PWMSTA WERR1 flag),
+    which can only happen if the FIFO is also written by other means.'''
+
+    def __init__(self, source=None, interval=_STREAM_INTERVAL):
+        '''Creates a PWM FIFO stream (without starting it).
+        @param source: the first source to write (see feed())
+        @param interval: the time to sleep when the FIFO is full, in seconds
+        '''
+
+        self.interval = interval
+        self.underruns = 0
+        self.overruns = 0
+
+        self._cond = threading.Condition()
+        self._current = None # the iterator being written
+        self._pending = None # the iterator to write next
+        self._thread = None
+        self._stop = False
+        self._error = None # the exception that ended the background thread
+
+        if source is not None:
+            self.feed(source)
+
+    def feed(self, source, timeout=None):
+        '''Queues a source to be written after the ones already queued.
+        If a source is already waiting to be written, blocks until
+        the stream starts writing it. Buffers are not copied, therefore
+        their contents should not be changed until the stream is done
+        with them (i.e. until two more sources were fed, or wait() returns).
+        Returns False if the timeout expired, True otherwise.
+        Raises the exception that stopped the background thread, if any
+        (e.g. an invalid value produced by an iterable).
+        @param source: an iterable of 32 bit integers, or a buffer-protocol
+        object (e.g. an array or a NumPy array) of integers
+        @param timeout: the maximum time to wait, in seconds;
+        if None, waits as long as needed
+        '''
+
+        try:
+            source = memoryview(source)
+
+        except TypeError:
+            pass
+
+        else:
+            _check_words(source)
+
+        it = iter(source)
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending is None or self._error is not None, timeout):
+                return False
+
+            if self._error is not None:
+                raise self._error
+
+            if self._current is None:
+                self._current = it
+
+            else:
+                self._pending = it
+
+            self._cond.notify_all()
+
+        return True
+
+    def wait(self, timeout=None):
+        '''Waits until all the queued data was written to the FIFO.
+        Returns False if the timeout expired, True otherwise.
+        Raises the exception that stopped the background thread, if any.
+        @param timeout: the maximum time to wait, in seconds;
+        if None, waits as long as needed
+        '''
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._current is None or self._error is not None, timeout):
+                return False
+
+            if self._error is not None:
+                raise self._error
+
+            return True
+
+    def start(self):
+        '''Starts the background thread that writes the FIFO.
+        '''
+
+        if self._thread is not None:
+            raise Exception('Stream already started')
+
+        self._stop = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the background thread and waits for it to finish.
+        The data that was not yet written remains queued.
+        Also forgets the exception that stopped the thread, if any.
+        '''
+
+        if self._thread is None:
+            return
+
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+
+        self._thread.join()
+        self._thread = None
+        self._error = None
+
+    def _run(self):
+        try:
+            self._write()
+
+        except Exception as e:
+            # the source that caused the error is dropped, along with the next one
+            with self._cond:
+                self._error = e
+                self._current = None
+                self._pending = None
+                self._cond.notify_all()
+
+    def _write(self):
+        words = _sta_reg.mapped_words()
+        sta_index = _sta_reg.index
+        fif_index = _fif_reg.index
+
+        it = None
+        while not self._stop:
+            if it is None:
+                with self._cond:
+                    while self._current is None and not self._stop:
+                        self._cond.wait()
+
+                    it = self._current
+
+                # forget the flags raised while there was nothing to write
+                words[sta_index] = _STA_ERRORS
+                continue
+
+            sta = words[sta_index]
+            if sta & _STA_ERRORS:
+                if sta & (_STA_RERR | _STA_GAPO):
+                    self.underruns += 1
+
+                if sta & _STA_WERR:
+                    self.overruns += 1
+
+                words[sta_index] = sta & _STA_ERRORS
+
+            if sta & _STA_FULL:
+                time.sleep(self.interval)
+                continue
+
+            for value in it:
+                words[fif_index] = value
+                if words[sta_index] & _STA_FULL:
+                    break
+
+            else: # switch to the pending source, if any
+                with self._cond:
+                    self._current = self._pending
+                    self._pending = None
+                    self._cond.notify_all()
+
+                    it = self._current
+
+
+def _check_words(buf):
+    '''Makes sure that a buffer holds integers that fit in the FIFO.'''
+
+    if buf.ndim != 1 or buf.format.lstrip('@=<>!') not in _INT_FORMATS:
+        raise Exception('Invalid buffer format')
+
+    # only the wide or signed integers need to be checked one by one
+    if len(buf) and (buf.itemsize > 4 or buf.format[-1].islower()):
+        if min(buf) < 0 or max(buf) > 0xFFFFFFFF:
+            raise Exception('Invalid buffer value')
+
+
+class LedStrip(object):
+    '''Drives a strip of WS2812-like LEDs connected to a PWM output,
+    using the serializer mode: each data bit is sent as a symbol of 3 or 4
+    serializer bits, with the PWM clock at 2.4 or 3.2 MHz.
+    The pixels are encoded using a lookup table that gives the symbols
+    of every byte value, into output buffers that are reused from frame
+    to frame. The frames are either fed to the FIFO by a DMA channel,
+    or streamed through the FIFO by a thread (see Stream). The latter is
+    only best-effort: the FIFO holds about 213 us of output at 2.4 MHz,
+    so a thread that is not scheduled in time underruns it, which the LEDs
+    take for the end of the frame. Use a DMA channel where possible.
+    Warning: the PWM clock is shared by both PWM peripherals.'''
+
+    def __init__(self, count, pwm_no=0, order='GRB', symbol_bits=3, reset_us=300, dma_channel=None):
+        '''Creates an LED strip driver.
+        @param count: the number of LEDs
+        @param pwm_no: the identifier of the PWM peripheral (0 or 1)
+        @param order: the order in which the LEDs expect the color channels,
+        e.g. 'GRB' (most WS2812 strips) or 'GRBW' (RGBW strips)
+        @param symbol_bits: the number of serializer bits per data bit (3 or 4)
+        @param reset_us: the low time that ends a frame, in microseconds
+        @param dma_channel: the number of the DMA channel that feeds
+        the FIFO (see dma.pwm_write()); if None, the frames are streamed
+        by a thread instead
+        '''
+
+        if pwm_no not in (0, 1):
+            raise Exception('Invalid PWM number')
+
+        if symbol_bits not in _LED_SYMBOLS:
+            raise Exception('Invalid symbol bits')
+
+        channels = len(order)
+        if sorted(order) != sorted('RGBW'[:channels]) or channels < 3:
+            raise Exception('Invalid color order')
+
+        self.count = count
+        self.pwm_no = pwm_no
+        self.symbol_bits = symbol_bits
+        self.channels = channels
+        self.dma_channel = dma_channel
+
+        # the input channel that goes to each position
+        self._order_map = [(i, 'RGBW'.index(c)) for i, c in enumerate(order)]
+
+        # the big endian symbols of every byte value
+        zero, one = _LED_SYMBOLS[symbol_bits]
+        self._table = []
+        for byte in range(256):
+            value = 0
+            for i in range(7, -1, -1):
+                value = (value << symbol_bits) | (one if byte >> i & 1 else zero)
+
+            self._table.append(value.to_bytes(symbol_bits, 'big'))
+
+        # the encoded data, followed by enough zero words for the reset time
+        data_len = count * channels * symbol_bits
+        reset_words = -(-reset_us * _LED_BIT_RATE * symbol_bits // 32000000)
+        self._data_len = data_len
+        self._ordered = bytearray(count * channels)
+
+        # the stream does not copy the buffers, so a buffer can only be
+        # reused after two more frames were fed (see Stream.feed())
+        self._buffers = [array.array('I', bytes(4 * (-(-data_len // 4) + reset_words)))
+                for i in range(3)]
+        self._next = 0
+        self._stream = None
+
+    def configure(self):
+        '''Configures and starts the PWM peripheral and its clock,
+        which is driven by the oscillator.
+        '''
+
+        configure(self.pwm_no, serial_mode=True, use_fifo=True)
+        configure_clock(clock.SRC_OSC, 19200000 // (_LED_BIT_RATE * self.symbol_bits))
+        set_range(self.pwm_no, 32)
+        clear_fifo()
+        start(self.pwm_no)
+
+    def encode(self, pixels):
+        '''Encodes a frame into the next output buffer, which is not
+        in use by the stream. The buffer only changes once the frame
+        was queued by show(), so it is overwritten by the next call.
+        Returns the buffer, an array of FIFO words.
+        @param pixels: the color channels of all the LEDs, in RGB(W) order
+        (bytes, bytearray or any other buffer-protocol object)
+        '''
+
+        if not isinstance(pixels, (bytes, bytearray)):
+            pixels = bytes(memoryview(pixels).cast('B'))
+
+        channels = self.channels
+        if len(pixels) != self.count * channels:
+            raise Exception('Invalid pixels length')
+
+        ordered = self._ordered
+        for dst, src in self._order_map:
+            ordered[dst::channels] = pixels[src::channels]
+
+        words = self._buffers[self._next]
+
+        # the serializer shifts out the most significant bit first,
+        # so the bytes of the words are laid out in big endian order
+        # while encoding (which keeps the padding of the last word)
+        mem = memoryview(words).cast('B')
+        if sys.byteorder == 'little':
+            words.byteswap()
+            mem[:self._data_len] = b''.join(map(self._table.__getitem__, ordered))
+            words.byteswap()
+
+        else:
+            mem[:self._data_len] = b''.join(map(self._table.__getitem__, ordered))
+
+        return words
+
+    def show(self, pixels, timeout=None):
+        '''Encodes a frame and queues it to be streamed through the FIFO,
+        right after the previous frame. Blocks while a frame
+        is already waiting to be streamed. With a DMA channel,
+        the frame is fed to the FIFO right away instead, blocking until
+        it was entirely written to the FIFO, and the timeout is ignored.
+        Returns False if the timeout expired, True otherwise.
+        @param pixels: the color channels of all the LEDs (see encode())
+        @param timeout: the maximum time to wait, in seconds;
+        if None, waits as long as needed
+        '''
+
+        if self.dma_channel is not None:
+            dma.pwm_write(self.dma_channel, self.encode(pixels))
+            self._next = (self._next + 1) % len(self._buffers)
+
+            return True
+
+        if self._stream is None:
+            self._stream = Stream()
+            self._stream.start()
+
+        # the buffer about to be encoded was fed three frames ago,
+        # and the stream is done with it since the last feed() returned;
+        # a frame that was not queued leaves its buffer free
+        if not self._stream.feed(self.encode(pixels), timeout):
+            return False
+
+        self._next = (self._next + 1) % len(self._buffers)
+
+        return True
+
+    def close(self):
+        '''Waits for the queued frames to be streamed,
+        then stops the stream.
+        '''
+
+        if self._stream is not None:
+            self._stream.wait()
+            self._stream.stop()
+            self._stream = None
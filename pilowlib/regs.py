@@ -23,11 +23,15 @@ import mmap
 import os
 import struct
 import sys
+import threading
+import types
 
 _PAGE_SIZE = 4096 # RPi kernel page size
 
 _BCM2708_PERI_BASE = 0x20000000 # RPi peripherals start address
+_BCM2708_PERI_BUS_BASE = 0x7E000000 # RPi peripherals start address, as seen by DMA
 _ST_BASE =           0x00003000 # System Timer offset address
+_DMA_BASE =          0x00007000 # DMA regs offset address
 _TMR_BASE =          0x0000B000 # Timer regs offset address
 _PADS_BASE =         0x00100000 # Pads regs offset address
 _CLK_BASE =          0x00101000 # Clock regs offset address
@@ -42,83 +46,316 @@ _AUX_BASE =          0x00215000 # AUX regs offset address
 _BSC1_BASE =         0x00804000 # BSC1 regs offset address
 _BSC2_BASE =         0x00805000 # BSC2 regs offset address
 
-_tmr_mem = [] # provides raw access to the Timer regs mapped memory
-_clk_mem = [] # provides raw access to the Clock regs mapped memory
-_gpio_mem = [] # provides raw access to the GPIO regs mapped memory
-_pcm_mem = [] # provides raw access to the PCM regs mapped memory
-_pwm_mem = [] # provides raw access to the PWM regs mapped memory
-_spi0_mem = [] # provides raw access to the SPI0 regs mapped memory
-
-
-def _map_periph_memory():
-    '''Calls 'mmap' for each memory page
-    and sets the corresponding global _*_mem objects
-    to the mapped memory objects.'''
-    
-    # open /dev/mem
-    dev_mem = os.open('/dev/mem', os.O_RDWR | os.O_SYNC)
-
-    # mmap the Timer
-    global _tmr_mem
-    _tmr_mem = mmap.mmap(
-            dev_mem,
-            length=_PAGE_SIZE,
-            flags=mmap.MAP_SHARED,
-            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-            offset=_BCM2708_PERI_BASE + _TMR_BASE)
-
-    # map the Clock
-    global _clk_mem
-    _clk_mem = mmap.mmap(
-            dev_mem,
-            length=_PAGE_SIZE,
-            flags=mmap.MAP_SHARED,
-            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-            offset=_BCM2708_PERI_BASE + _CLK_BASE)
-
-    # mmap the GPIO
-    global _gpio_mem
-    _gpio_mem = mmap.mmap(
-            dev_mem,
-            length=_PAGE_SIZE,
-            flags=mmap.MAP_SHARED,
-            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-            offset=_BCM2708_PERI_BASE + _GPIO_BASE)
-
-    # map the PCM
-    global _pcm_mem
-    _pcm_mem = mmap.mmap(
-            dev_mem,
-            length=_PAGE_SIZE,
-            flags=mmap.MAP_SHARED,
-            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-            offset=_BCM2708_PERI_BASE + _PCM_BASE)
-
-    # map the PWM
-    global _pwm_mem
-    _pwm_mem = mmap.mmap(
-            dev_mem,
-            length=_PAGE_SIZE,
-            flags=mmap.MAP_SHARED,
-            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-            offset=_BCM2708_PERI_BASE + _PWM_BASE)
-
-    # map the PWM
-    global _spi0_mem
-    _spi0_mem = mmap.mmap(
-            dev_mem,
-            length=_PAGE_SIZE,
-            flags=mmap.MAP_SHARED,
-            prot=mmap.PROT_READ | mmap.PROT_WRITE,
-            offset=_BCM2708_PERI_BASE + _SPI0_BASE)
+_BACKEND_ENV = 'PILOWLIB_BACKEND' # selects the default backend
+
+# the initial values of the status registers that are polled by
+# the library, used by the memory backend to look like an idle peripheral
+# (by peripheral offset, then by register offset)
+_MEMORY_STATUS_VALUES = {
+    _SPI0_BASE: {0x00: 0x00070000}, # SPI0CS: TXD, RXD and DONE set
+}
+
+# the peripherals that are mapped, along with their offsets
+_periph_offsets = {
+    'st': _ST_BASE,
+    'dma': _DMA_BASE,
+    'tmr': _TMR_BASE,
+    'clk': _CLK_BASE,
+    'gpio': _GPIO_BASE,
+    'pcm': _PCM_BASE,
+    'pwm': _PWM_BASE,
+    'spi0': _SPI0_BASE,
+    'aux': _AUX_BASE,
+}
+
+_backend = None # the backend that provides the peripherals memory
+_mem = {} # provides raw access to the mapped memory of each peripheral
+_words = {} # the 32 bit words views of the mapped memory of each peripheral
+_lock = threading.Lock() # serializes the mappings
+_registers = {} # all the registers, by name
+
+
+class Backend(object):
+    '''The base class for the objects that provide
+    the memory pages of the peripherals. A backend maps a page
+    at a given peripheral offset and returns a writable
+    buffer object (normally an mmap object).'''
+
+    def map(self, offs, length=_PAGE_SIZE):
+        '''Maps and returns the memory of a peripheral.
+        @param offs: the offset of the peripheral,
+        relative to the peripherals start address
+        @param length: the length of the mapped memory
+        '''
+
+        raise NotImplementedError()
+
+    def close(self):
+        '''Releases any resources held by the backend.
+        The memory returned by map() is not affected.
+        '''
+
+        pass
+
+
+class DevMemBackend(Backend):
+    '''Maps the real peripherals memory using /dev/mem.
+    This is the default backend and it requires full
+    root access on a Raspberry PI.'''
+
+    def __init__(self, path='/dev/mem', base=_BCM2708_PERI_BASE):
+        '''Creates a /dev/mem backend.
+        @param path: the path of the physical memory device
+        @param base: the peripherals start address
+        '''
+
+        self.path = path
+        self.base = base
+        self.fd = None
+
+    def map(self, offs, length=_PAGE_SIZE):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_SYNC)
+
+        return mmap.mmap(
+                self.fd,
+                length=length,
+                flags=mmap.MAP_SHARED,
+                prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                offset=self.base + offs)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MemoryBackend(Backend):
+    '''Provides plain memory instead of the real peripherals,
+    allowing the library to be used (and timed) on any machine.
+    The memory is either anonymous or backed by a file,
+    in which case other processes can map the same file
+    to inspect and alter the register values.
+    Note that no peripheral behavior is emulated: the registers
+    simply hold the last written values. Only the status bits polled
+    by the library are initially set as for an idle peripheral
+    (e.g. SPI0CS TXD, RXD and DONE), so that the waits on them
+    do not last forever; once overwritten (e.g. by spi.configure()),
+    they have to be set again by hand. Waits on changing values
+    (e.g. systimer.sleep_until()) never end.'''
+
+    def __init__(self, path=None):
+        '''Creates a memory backend.
+        @param path: the path of the file that backs the memory;
+        if None, anonymous memory is used
+        '''
+
+        self.path = path
+        self.fd = None
+        self.new = True # tells whether the file was created by this backend
+
+    def map(self, offs, length=_PAGE_SIZE):
+        if self.path is None:
+            mem = mmap.mmap(-1, length)
+            self._init_status(mem, offs)
+
+            return mem
+
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+            # the values left by other processes are kept
+            self.new = os.fstat(self.fd).st_size == 0
+
+        # the file mirrors the peripherals address space,
+        # so make sure it is large enough for this page
+        if os.fstat(self.fd).st_size < offs + length:
+            os.ftruncate(self.fd, offs + length)
+
+        mem = mmap.mmap(
+                self.fd,
+                length=length,
+                flags=mmap.MAP_SHARED,
+                prot=mmap.PROT_READ | mmap.PROT_WRITE,
+                offset=offs)
+
+        if self.new:
+            self._init_status(mem, offs)
+
+        return mem
+
+    def _init_status(self, mem, offs):
+        for reg_offs, value in _MEMORY_STATUS_VALUES.get(offs, {}).items():
+            struct.pack_into('<I', mem, reg_offs, value)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _default_backend():
+    '''Creates the backend indicated by the PILOWLIB_BACKEND
+    environment variable, which can be one of:
+        * devmem (default) - the real peripherals, using /dev/mem
+        * memory - anonymous memory
+        * memory:/path/to/file - file-backed memory
+    '''
+
+    name = os.environ.get(_BACKEND_ENV, 'devmem')
+    if name == 'devmem':
+        return DevMemBackend()
+
+    elif name == 'memory':
+        return MemoryBackend()
+
+    elif name.startswith('memory:'):
+        return MemoryBackend(name[7:])
+
+    else:
+        raise Exception('Invalid backend: %s' % name)
+
+
+def _map(periph):
+    '''Maps the memory of a peripheral, if not already mapped,
+    and points the peripheral's registers to it.
+    Returns the 32 bit words view of the mapped memory.
+    @param periph: the name of the peripheral (e.g. "gpio")
+    '''
+
+    global _backend
+
+    with _lock:
+        words = _words.get(periph)
+        if words is not None:
+            return words
+
+        if _backend is None:
+            _backend = _default_backend()
+
+        mem = _backend.map(_periph_offsets[periph])
+
+        # the registers access the memory as 32 bit words,
+        # through a view that is created only once per peripheral
+        words = memoryview(mem).cast('I')
+
+        _mem[periph] = mem
+        _words[periph] = words
+        for reg in _registers.values():
+            if reg.periph == periph:
+                reg.words = words
+
+        return words
+
+
+class _UnmappedWords(object):
+    '''Stands for the memory of a peripheral that
+    was not mapped yet. The memory is mapped upon the first
+    register access, after which the registers no longer
+    refer to this object.'''
+
+    __slots__ = ('periph',)
+
+    def __init__(self, periph):
+        self.periph = periph
+
+    def __getitem__(self, index):
+        return _map(self.periph)[index]
+
+    def __setitem__(self, index, value):
+        _map(self.periph)[index] = value
+
+
+def open(backend=None):
+    '''Selects the backend that provides the memory
+    of the peripherals. Any previously mapped memory is released.
+    The memory of each peripheral is mapped only when
+    one of its registers is first accessed, so calling this
+    function is optional when the default backend is used.
+    @param backend: a Backend object; if None,
+    the default backend is used
+    '''
+
+    global _backend
+
+    close()
+
+    if backend is None:
+        backend = _default_backend()
+
+    _backend = backend
+
+
+def close():
+    '''Releases the mapped memory of all the peripherals,
+    as well as the resources held by the backend.
+    Registers can still be accessed afterwards,
+    in which case the memory is mapped again.
+    '''
+
+    global _backend
+
+    with _lock:
+        for reg in _registers.values():
+            reg.words = _UnmappedWords(reg.periph)
+
+        for words in _words.values():
+            words.release()
+
+        for mem in _mem.values():
+            mem.close()
+
+        _words.clear()
+        _mem.clear()
+
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+
+
+def register(name):
+    '''Returns the register object with the given name.
+    Unlike regs.NAME, which reads the register, this allows
+    keeping a reference to the register itself,
+    which is useful in time critical code.
+    @param name: the name of the register (e.g. "GPSET0")
+    '''
+
+    reg = _registers.get(name)
+    if reg is None:
+        raise Exception('Invalid register')
+
+    return reg
+
+
+def modify(reg, clear_mask, set_mask):
+    '''Clears and sets bits of a register using
+    a single read and a single write, so that the register
+    never holds an intermediate value.
+    @param reg: the register, given either by name (e.g. "GPFSEL0")
+    or as a register object (see register())
+    @param clear_mask: the bits to clear
+    @param set_mask: the bits to set (after clearing)
+    '''
+
+    if not isinstance(reg, _Register):
+        reg = register(reg)
+
+    words = reg.words
+    index = reg.index
+    words[index] = (words[index] & ~clear_mask) | set_mask
 
 
 class _Register(object):
     '''Represents a single register.
     Defines a setter and a getter to allow
     reading and assigning values with a simple syntax:
-        regs.REG1 = 0xDEADBEEF'''
-    
+        regs.REG1 = 0xDEADBEEF
+    The register accesses its word directly in the
+    mapped memory, without allocating anything.'''
+
+    __slots__ = ('periph', 'offs', 'len', 'words', 'index')
+
     def __init__(self, periph, offs, len=4):
         '''Constructs a register variable assigned to
         the given peripheral, address offset and length.
@@ -126,72 +363,105 @@ class _Register(object):
         @param offs: the offset in the peripheral's mapped memory
         @param len: the length of the register in bytes, normally 4
         '''
-        
+
         self.periph = periph
         self.offs = offs
         self.len = len
-    
+        self.words = _UnmappedWords(periph) # the 32 bit words view of the peripheral memory
+        self.index = offs // 4 # the index of the register in words
+
+    def __get__(self, module, type=None):
+        if module is None:
+            return self
+
+        return self.words[self.index]
+
+    def __set__(self, module, value):
+        self.words[self.index] = value
+
+    @property
+    def bus_address(self):
+        '''The address of the register as seen by
+        the DMA controller.'''
+
+        return _BCM2708_PERI_BUS_BASE + _periph_offsets[self.periph] + self.offs
+
     @property
     def mem(self):
         '''Allows raw access to the peripheral memory
         associated with this register.'''
-        
-        return {
-            'tmr': _tmr_mem,
-            'clk': _clk_mem,
-            'gpio': _gpio_mem,
-            'pcm': _pcm_mem,
-            'pwm': _pwm_mem,
-            'spi0': _spi0_mem,
-        }[self.periph]
-        
+
+        if self.periph not in _mem:
+            _map(self.periph)
+
+        return _mem[self.periph]
+
+    def mapped_words(self):
+        '''Returns the 32 bit words view of the memory
+        of the register's peripheral, mapping it if needed.
+        The register is found at the index attribute of the view.
+        The view is valid until close() is called.'''
+
+        return _map(self.periph)
+
     def get(self):
         '''Returns the value of the register as an integer.'''
-        
-        s = self.mem[self.offs:self.offs + self.len]
-        
-        return struct.unpack('I', s)[0]
+
+        return self.words[self.index]
 
     def set(self, value):
         '''Sets the value of the register.
         @param value: the value (an integer) to set'''
-        
-        s = struct.pack('I', value)
-        
-        self.mem[self.offs:self.offs + self.len] = s
-
 
-class _ModuleWrapper(object):
-    '''A class that wraps the 'regs' module
-    by redefining setters and getters for the registers.'''
-    
-    def __init__(self, module):
-        self.module = module
+        self.words[self.index] = value
 
-    def __getattr__(self, name):
-        value = getattr(self.module, name)
-        if isinstance(value, _Register):
-            return value.get()
 
-        else:
-            return value
+class _RegsModule(types.ModuleType):
+    '''The class of the 'regs' module. The registers are
+    added to this class as descriptors, so that reading or
+    assigning regs.REG1 directly accesses the register.'''
 
-    def __setattr__(self, name, value):
-        if name == 'module':
-            self.__dict__[name] = value
-
-        else:
-            old_value = getattr(self.module, name)
-            if isinstance(old_value, _Register):
-                old_value.set(value)
-
-            else:
-                setattr(self.module, name, value)
+    pass
 
 
 def _wrap_module():
-    sys.modules[__name__] = _ModuleWrapper(sys.modules[__name__])
-
+    for name, value in globals().items():
+        if isinstance(value, _Register):
+            _registers[name] = value
+            setattr(_RegsModule, name, value)
+
+    sys.modules[__name__].__class__ = _RegsModule
+
+
+# System Timer registers
+STCS = _Register('st', 0x00)
+STCLO = _Register('st', 0x04)
+STCHI = _Register('st', 0x08)
+STC0 = _Register('st', 0x0C)
+STC1 = _Register('st', 0x10)
+STC2 = _Register('st', 0x14)
+STC3 = _Register('st', 0x18)
+
+# DMA registers, for each of the channels 0..14
+# (DMA0CS, DMA0CONBLKAD, ..., DMA14DEBUG)
+for _channel in range(15):
+    _offs = _channel * 0x100
+    globals().update({
+        'DMA%dCS' % _channel: _Register('dma', _offs + 0x00),
+        'DMA%dCONBLKAD' % _channel: _Register('dma', _offs + 0x04),
+        'DMA%dTI' % _channel: _Register('dma', _offs + 0x08),
+        'DMA%dSOURCEAD' % _channel: _Register('dma', _offs + 0x0C),
+        'DMA%dDESTAD' % _channel: _Register('dma', _offs + 0x10),
+        'DMA%dTXFRLEN' % _channel: _Register('dma', _offs + 0x14),
+        'DMA%dSTRIDE' % _channel: _Register('dma', _offs + 0x18),
+        'DMA%dNEXTCONBK' % _channel: _Register('dma', _offs + 0x1C),
+        'DMA%dDEBUG' % _channel: _Register('dma', _offs + 0x20),
+    })
+
+del _channel, _offs
+
+DMAINTSTATUS = _Register('dma', 0xFE0)
+DMAENABLE = _Register('dma', 0xFF0)
 
 # Timer registers
 TMRLD = _Register('tmr', 0x400)
@@ -272,10 +542,25 @@ SPI0FIFO = _Register('spi0', 0x04)
 SPI0CLK = _Register('spi0', 0x08)
 SPI0DLEN = _Register('spi0', 0x0C)
 SPI0LTOH = _Register('spi0', 0x10)
-SPI0DC = _Register('spi0', 0x04)
-
-# perform the memory mappings, as well as
-# wrapping the module as soon as the module
-# is imported for the first time
-_map_periph_memory()
+SPI0DC = _Register('spi0', 0x14)
+
+# AUX registers (SPI1 and SPI2)
+AUXIRQ = _Register('aux', 0x00)
+AUXENB = _Register('aux', 0x04)
+SPI1CNTL0 = _Register('aux', 0x80)
+SPI1CNTL1 = _Register('aux', 0x84)
+SPI1STAT = _Register('aux', 0x88)
+SPI1PEEK = _Register('aux', 0x8C)
+SPI1IO = _Register('aux', 0xA0)
+SPI1TXHOLD = _Register('aux', 0xB0)
+SPI2CNTL0 = _Register('aux', 0xC0)
+SPI2CNTL1 = _Register('aux', 0xC4)
+SPI2STAT = _Register('aux', 0xC8)
+SPI2PEEK = _Register('aux', 0xCC)
+SPI2IO = _Register('aux', 0xE0)
+SPI2TXHOLD = _Register('aux', 0xF0)
+
+# wrap the module as soon as the module
+# is imported for the first time; the memory
+# of the peripherals is mapped on demand
 _wrap_module()
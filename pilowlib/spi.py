@@ -19,8 +19,90 @@
 peripheral of the RPi.
 '''
 
-import regs
-import utils
+import collections
+import threading
+
+from pilowlib import regs
+
+# SPI0CS bits
+_CS_CLEAR = 0x30
+_CS_TA = 0x80
+_CS_DMAEN = 0x100
+_CS_ADCS = 0x800
+_CS_DONE = 0x10000
+_CS_RXD = 0x20000
+_CS_TXD = 0x40000
+
+_cs_reg = regs.register('SPI0CS')
+_fifo_reg = regs.register('SPI0FIFO')
+
+
+class _Lock(object):
+    '''A lock that can be acquired again by its owner, which is
+    either a thread (by default) or an asyncio task (see aio).
+    Unlike an RLock held by a coroutine across awaits, it does not let
+    the other code running on the thread of the event loop in.'''
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._owner = None
+        self._thread = None # the thread of the owner
+        self._count = 0
+
+    def acquire(self, blocking=True, owner=None):
+        '''Acquires the lock. Returns True if the lock was acquired,
+        False if it is held by another owner and blocking is False.
+        @param blocking: whether to wait for the lock to be released
+        @param owner: the acquiring asyncio task; if None,
+        the current thread is the owner
+        '''
+
+        thread = threading.get_ident()
+        if owner is None:
+            owner = thread
+
+        with self._condition:
+            while self._count and self._owner != owner:
+                if not blocking:
+                    return False
+
+                if self._thread == thread:
+                    # waiting would block the coroutine that holds the lock
+                    raise Exception('SPI0 in use by a coroutine')
+
+                self._condition.wait()
+
+            self._owner = owner
+            self._thread = thread
+            self._count += 1
+
+            return True
+
+    def release(self):
+        '''Releases the lock once.'''
+
+        with self._condition:
+            if not self._count:
+                raise Exception('Lock not acquired')
+
+            self._count -= 1
+            if not self._count:
+                self._owner = None
+                self._thread = None
+                self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# serializes the use of SPI0 by all the modules (see also Bus),
+# along with the configuration last written while holding it
+_lock = _Lock()
+_active_cs = None # the current SPI0CS configuration
+_active_clk = None # the current SPI0CLK value
 
 
 def configure(clock_rest_polarity=0, clock_phase=1, clock_divider=0, chip_select0=None, chip_select1=None):
@@ -43,8 +125,27 @@ def configure(clock_rest_polarity=0, clock_phase=1, clock_divider=0, chip_select
     when transmitting data; if None is passed, chip select 1 will not be asserted
     at all during transmission 
     '''
+
+    global _active_cs, _active_clk
+
+    cs = _cs_value(clock_rest_polarity, clock_phase, chip_select0, chip_select1)
+
+    with _lock:
+        regs.SPI0CS = cs
+
+        # set the clock divider
+        regs.SPI0CLK = clock_divider
+
+        _active_cs = cs
+        _active_clk = clock_divider
+
+
+def _cs_value(clock_rest_polarity, clock_phase, chip_select0, chip_select1):
+    '''Returns the value of the SPI0CS register corresponding
+    to the given configuration (see configure()).'''
+
     value = 0
-    
+
     if clock_rest_polarity:
         value |= 0x08
     
@@ -68,42 +169,37 @@ def configure(clock_rest_polarity=0, clock_phase=1, clock_divider=0, chip_select
     if chip_select1 == 1:
         value |= 0x400000
     
-    regs.SPI0CS = value
-    
-    # set the clock divider
-    regs.SPI0CLK = clock_divider
+    return value
 
 
 def transfer_value(value):
     '''Reads and writes one byte from and to the SPI.
-    @var value: the byte to write 
+    @var value: the byte to write
     @return: the byte that was read
     '''
-    
-    # clear the TX and RX fifos
-    regs.SPI0CS |= 0x30
-    
-    # set the TA flag
-    regs.SPI0CS |= 0x80
-    
-    # wait for TXD flag
-    while regs.SPI0CS & 0x40000 == 0:
-        utils.nanosleep(0, 5)
-    
-    # write the value to the TX fifo
-    regs.SPI0FIFO = value & 0xFF
-    
-    # wait for DONE flag to be set
-    while regs.SPI0CS & 0x10000 == 0:
-        utils.nanosleep(0, 5)
-    
-    # read the received value
-    value = regs.SPI0FIFO
-    
-    # clear the TA flag
-    regs.SPI0CS &= 0xFFFFFF7F
-    
-    return value
+
+    with _lock:
+        # clear the TX and RX fifos and set the TA flag
+        regs.modify(_cs_reg, 0, _CS_CLEAR | _CS_TA)
+
+        try:
+            # wait for TXD flag
+            while not regs.SPI0CS & _CS_TXD:
+                pass
+
+            # write the value to the TX fifo
+            regs.SPI0FIFO = value & 0xFF
+
+            # wait for DONE flag to be set
+            while not regs.SPI0CS & _CS_DONE:
+                pass
+
+            # read the received value
+            return regs.SPI0FIFO
+
+        finally:
+            # clear the TA flag
+            regs.modify(_cs_reg, _CS_TA, 0)
 
 
 def transfer_values(values):
@@ -111,35 +207,344 @@ def transfer_values(values):
     @var values: the list of bytes to write 
     @return: the bytes that were read
     '''
-    
-    # clear the TX and RX fifos
-    regs.SPI0CS |= 0x30
-    
-    # set the TA flag
-    regs.SPI0CS |= 0x80
-    
-    read_values = []
-    
-    for value in values:
-        # wait for TXD flag to be set
-        while regs.SPI0CS & 0x40000 == 0:
-            utils.nanosleep(0, 5)
-        
-        # write the value to the TX fifo
-        regs.SPI0FIFO = value & 0xFF
-        
-        # wait for RXD flag to be set
-        while regs.SPI0CS & 0x20000 == 0:
-            utils.nanosleep(0, 5)
-        
-        # read the received value
-        read_values.append(regs.SPI0FIFO)
-    
-    # wait for DONE flag to be set
-    while regs.SPI0CS & 0x10000 == 0:
-        utils.nanosleep(0, 5)
-    
-    # clear the TA flag
-    regs.SPI0CS &= 0xFFFFFF7F
-    
-    return read_values
+
+    return list(transfer(bytearray(value & 0xFF for value in values)))
+
+
+def transfer(data):
+    '''Reads and writes a buffer of bytes from and to the SPI.
+    The TX FIFO is kept topped up while the RX FIFO is drained,
+    so that the bus does not idle between bytes.
+    @var data: the bytes to write (bytes, bytearray or memoryview)
+    @return: the bytes that were read, as a bytearray
+    '''
+
+    data = _byte_buffer(data)
+    read_data = bytearray(len(data))
+
+    _transfer(data, read_data, len(data))
+
+    return read_data
+
+
+def transfer_into(data, read_data):
+    '''Reads and writes bytes from and to the SPI using
+    caller-provided buffers, without allocating any memory.
+    As many bytes as there are in data are transferred.
+    @var data: the bytes to write (any buffer-protocol object)
+    @var read_data: the writable buffer to read into (any buffer-protocol
+    object), at least as long as data
+    @return: the number of transferred bytes
+    '''
+
+    data = _byte_buffer(data)
+    read_data = _writable_byte_buffer(read_data)
+    if len(read_data) < len(data):
+        raise Exception('Read buffer too small')
+
+    _transfer(data, read_data, len(data))
+
+    return len(data)
+
+
+def write(data):
+    '''Writes bytes to the SPI, discarding the bytes that are read.
+    @var data: the bytes to write (any buffer-protocol object)
+    @return: the number of transferred bytes
+    '''
+
+    data = _byte_buffer(data)
+
+    _transfer(data, None, len(data))
+
+    return len(data)
+
+
+def read_into(read_data, fill=0x00):
+    '''Reads bytes from the SPI into a caller-provided buffer,
+    writing the same byte over and over.
+    @var read_data: the writable buffer to read into (any buffer-protocol
+    object); it is filled entirely
+    @var fill: the byte to write
+    @return: the number of transferred bytes
+    '''
+
+    read_data = _writable_byte_buffer(read_data)
+
+    _transfer(None, read_data, len(read_data), fill & 0xFF)
+
+    return len(read_data)
+
+
+def _byte_buffer(buf):
+    '''Returns an object that gives access to the bytes of
+    a buffer-protocol object by indexing. Byte strings and
+    byte arrays are used as they are.'''
+
+    if isinstance(buf, (bytes, bytearray)):
+        return buf
+
+    return memoryview(buf).cast('B')
+
+
+def _writable_byte_buffer(buf):
+    '''Same as _byte_buffer(), but rejects read-only buffers.'''
+
+    if isinstance(buf, bytearray):
+        return buf
+
+    buf = memoryview(buf)
+    if buf.readonly:
+        raise Exception('Read-only buffer')
+
+    return buf.cast('B')
+
+
+def _transfer(data, read_data, length, fill=0):
+    '''Writes length bytes and reads the same number of bytes,
+    interleaving the TX FIFO writes with the RX FIFO reads.
+    The SPI stalls when the RX FIFO is full,
+    therefore no data is lost while topping up the TX FIFO.
+    @var data: a sequence of bytes to write;
+    if None, the fill byte is written instead
+    @var read_data: a writable sequence of bytes to read into;
+    if None, the read bytes are discarded
+    @var length: the number of bytes to transfer
+    @var fill: the byte to write when data is None
+    '''
+
+    with _lock:
+        for progress in _transfer_steps(data, read_data, length, fill):
+            pass
+
+
+def _transfer_steps(data, read_data, length, fill=0):
+    '''Does the same as _transfer(), as a generator that yields
+    after each pass over the FIFOs whether any byte was transferred,
+    so that the caller can wait between the passes (see aio).
+    The caller must hold the lock. Closing the generator
+    before the end aborts the transfer.'''
+
+    words = _cs_reg.mapped_words()
+    cs_index = _cs_reg.index
+    fifo_index = _fifo_reg.index
+
+    # clear the TX and RX fifos and set the TA flag
+    regs.modify(_cs_reg, 0, _CS_CLEAR | _CS_TA)
+
+    try:
+        written = 0
+        read = 0
+        while read < length:
+            status = words[cs_index]
+            before = written + read
+
+            # top up the TX fifo
+            while written < length and status & _CS_TXD:
+                words[fifo_index] = data[written] if data is not None else fill
+                written += 1
+                status = words[cs_index]
+
+            # drain the RX fifo
+            while read < written and status & _CS_RXD:
+                value = words[fifo_index]
+                if read_data is not None:
+                    read_data[read] = value & 0xFF
+
+                read += 1
+                status = words[cs_index]
+
+            yield written + read != before
+
+        # wait for DONE flag to be set
+        while not words[cs_index] & _CS_DONE:
+            yield False
+
+    finally:
+        # clear the TA flag
+        regs.modify(_cs_reg, _CS_TA, 0)
+
+
+class Device(object):
+    '''A device attached to a Bus, along with its SPI configuration.
+    The SPI0CS and SPI0CLK values of the device are computed
+    only once, when the device is created.'''
+
+    def __init__(self, bus, clock_rest_polarity=0, clock_phase=1, clock_divider=0, chip_select0=None, chip_select1=None):
+        '''Creates a device (see Bus.device()).
+        @param bus: the Bus the device is attached to
+        The other parameters have the same meaning as for configure().
+        '''
+
+        if clock_divider < 0 or clock_divider > 0xFFFF:
+            raise Exception('Invalid clock divider')
+
+        self.bus = bus
+        self.cs = _cs_value(clock_rest_polarity, clock_phase, chip_select0, chip_select1)
+        self.clk = clock_divider
+
+    def transfer(self, data):
+        '''Transfers bytes to and from the device right away
+        (see Bus.transfer()).
+        '''
+
+        return self.bus.transfer(self, data)
+
+    def transfer_into(self, data, read_data):
+        '''Transfers bytes to and from the device right away,
+        using caller-provided buffers (see Bus.transfer_into()).
+        '''
+
+        return self.bus.transfer_into(self, data, read_data)
+
+    def submit(self, data):
+        '''Queues a transfer to and from the device
+        (see Bus.submit()).
+        '''
+
+        return self.bus.submit(self, data)
+
+
+class Transaction(object):
+    '''A queued transfer (see Bus.submit()).'''
+
+    def __init__(self, bus, device, data):
+        self.bus = bus
+        self.device = device
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        '''Waits for the transfer to be executed and returns the
+        bytes that were read, as a bytearray. If no other thread
+        is executing the queued transfers, the calling thread
+        executes them itself (see Bus.flush()).
+        '''
+
+        if not self.done.is_set():
+            self.bus.flush()
+            self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class Bus(object):
+    '''Shares SPI0 between several devices and threads.
+    Each transfer is done with the configuration of its device,
+    and the SPI0CS and SPI0CLK registers are only written when
+    the configuration actually changes. Queued transfers are grouped
+    by device when executed, so that the configuration changes
+    as rarely as possible; the transfers of the same device are
+    always executed in the order they were queued.
+    All the buses, as well as the other SPI0 functions of the library,
+    use the same lock, so SPI0 is never used by two of them at once.
+    The current configuration is also shared: the buses assume that
+    SPI0 is not configured other than by configure() or by a bus
+    (see reset()).'''
+
+    def __init__(self):
+        self._queue_lock = threading.Lock()
+        self._queue = collections.deque()
+
+    def device(self, **kwargs):
+        '''Creates a device attached to this bus.
+        The parameters have the same meaning as for configure().
+        '''
+
+        return Device(self, **kwargs)
+
+    def reset(self):
+        '''Forgets the current configuration of SPI0, so that it is
+        written again by the next transfer. Call this if SPI0 was
+        configured without going through this bus.
+        '''
+
+        global _active_cs, _active_clk
+
+        with _lock:
+            _active_cs = None
+            _active_clk = None
+
+    def transfer(self, device, data):
+        '''Transfers bytes to and from a device right away,
+        bypassing the queue (see spi.transfer()).
+        @param device: the Device to transfer to and from
+        @param data: the bytes to write (bytes, bytearray or memoryview)
+        '''
+
+        data = _byte_buffer(data)
+        read_data = bytearray(len(data))
+
+        with _lock:
+            self._select(device)
+            _transfer(data, read_data, len(data))
+
+        return read_data
+
+    def transfer_into(self, device, data, read_data):
+        '''Transfers bytes to and from a device right away,
+        bypassing the queue, using caller-provided buffers
+        (see spi.transfer_into()).
+        @param device: the Device to transfer to and from
+        @param data: the bytes to write (any buffer-protocol object)
+        @param read_data: the writable buffer to read into
+        '''
+
+        with _lock:
+            self._select(device)
+
+            return transfer_into(data, read_data)
+
+    def submit(self, device, data):
+        '''Queues a transfer to and from a device.
+        Returns a Transaction, whose wait() method
+        returns the bytes that were read.
+        @param device: the Device to transfer to and from
+        @param data: the bytes to write (bytes, bytearray or memoryview)
+        '''
+
+        transaction = Transaction(self, device, data)
+        with self._queue_lock:
+            self._queue.append(transaction)
+
+        return transaction
+
+    def flush(self):
+        '''Executes all the queued transfers, grouped by device,
+        in the order in which the devices first appear in the queue.
+        '''
+
+        with _lock:
+            with self._queue_lock:
+                transactions = list(self._queue)
+                self._queue.clear()
+
+            groups = collections.OrderedDict()
+            for transaction in transactions:
+                groups.setdefault(transaction.device, []).append(transaction)
+
+            for device, group in groups.items():
+                for transaction in group:
+                    try:
+                        transaction.result = self.transfer(device, transaction.data)
+
+                    except Exception as e:
+                        transaction.error = e
+
+                    transaction.done.set()
+
+    def _select(self, device):
+        global _active_cs, _active_clk
+
+        if _active_cs != device.cs:
+            regs.SPI0CS = device.cs
+            _active_cs = device.cs
+
+        if _active_clk != device.clk:
+            regs.SPI0CLK = device.clk
+            _active_clk = device.clk
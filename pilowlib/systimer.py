@@ -0,0 +1,155 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides access to the System Timer peripheral of the RPi,
+a free-running 64 bit counter incremented at 1 MHz,
+along with its 4 compare channels (numbered from 0 to 3).
+Channels 0 and 2 are used by the GPU, therefore only
+channels 1 and 3 should normally be used.
+'''
+
+from pilowlib import regs
+from pilowlib import utils
+
+FREQUENCY = 1000000 # the counter frequency, in Hz
+
+# the time before the deadline at which sleep_until()
+# stops sleeping and starts busy-waiting, in ticks
+_SPIN_TICKS = 200
+
+_clo_reg = regs.register('STCLO')
+_chi_reg = regs.register('STCHI')
+
+_compare_regs = [
+    regs.register('STC0'),
+    regs.register('STC1'),
+    regs.register('STC2'),
+    regs.register('STC3'),
+]
+
+
+def ticks():
+    '''Returns the current value of the 64 bit counter,
+    in microseconds. The two halves of the counter
+    are read consistently, even if the low half wraps around
+    between the reads.
+    '''
+
+    clo = _clo_reg
+    chi = _chi_reg
+
+    hi = chi.words[chi.index]
+    lo = clo.words[clo.index]
+    if chi.words[chi.index] != hi: # the low half has just wrapped around
+        hi = chi.words[chi.index]
+        lo = clo.words[clo.index]
+
+    return (hi << 32) | lo
+
+
+def ticks_ns():
+    '''Returns the value of the 64 bit counter converted
+    to nanoseconds, with a resolution of one microsecond.
+    This can be used as the clock of digital.Waveform.play()
+    and digital.capture().
+    '''
+
+    return ticks() * 1000
+
+
+def ticks32():
+    '''Returns the low 32 bits of the counter, in microseconds.
+    This is faster than ticks() and is enough for measuring
+    intervals shorter than about 71 minutes
+    (see ticks_diff()).
+    '''
+
+    clo = _clo_reg
+
+    return clo.words[clo.index]
+
+
+def ticks_diff(end, start):
+    '''Returns the number of ticks between two values
+    returned by ticks32(), taking the wraparound into account.
+    @param end: the later value
+    @param start: the earlier value
+    '''
+
+    return (end - start) & 0xFFFFFFFF
+
+
+def sleep_until(deadline):
+    '''Waits until the counter reaches the given value.
+    The calling thread sleeps while the deadline is far away
+    and busy-waits on the counter for the last few microseconds.
+    @param deadline: the awaited counter value (as returned by ticks())
+    '''
+
+    remaining = deadline - ticks()
+    if remaining <= 0:
+        return
+
+    if remaining > _SPIN_TICKS:
+        utils.delay_ns((remaining - _SPIN_TICKS) * 1000)
+
+    # busy-wait on the low half of the counter;
+    # the deadline is less than 2^31 ticks away here
+    clo = _clo_reg
+    words = clo.words
+    index = clo.index
+    deadline &= 0xFFFFFFFF
+    while (words[index] - deadline) & 0x80000000:
+        pass
+
+
+def set_compare(channel, value):
+    '''Sets the compare register of a channel and clears
+    its match flag. The channel matches when the low 32 bits
+    of the counter become equal to the given value.
+    @param channel: the number of the compare channel (0..3)
+    @param value: the counter value to match (only the low 32 bits are used)
+    '''
+
+    if channel < 0 or channel > 3:
+        raise Exception('Invalid compare channel')
+
+    _compare_regs[channel].set(value & 0xFFFFFFFF)
+    regs.STCS = 1 << channel
+
+
+def matched(channel):
+    '''Tells whether a channel has matched
+    since its match flag was last cleared.
+    @param channel: the number of the compare channel (0..3)
+    '''
+
+    if channel < 0 or channel > 3:
+        raise Exception('Invalid compare channel')
+
+    return bool(regs.STCS & (1 << channel))
+
+
+def clear_match(channel):
+    '''Clears the match flag of a channel.
+    @param channel: the number of the compare channel (0..3)
+    '''
+
+    if channel < 0 or channel > 3:
+        raise Exception('Invalid compare channel')
+
+    regs.STCS = 1 << channel
@@ -0,0 +1,165 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Provides configuration and control for the ARM Timer peripheral.
+The peripheral has a countdown timer (with automatic reload and
+an interrupt flag that can be polled) and a separate free-running
+32 bit counter. Both are driven by the core clock (normally 250 MHz),
+so their frequency changes if the core clock is scaled.
+'''
+
+from pilowlib import regs
+
+# countdown timer pre-scalers
+PRESCALE_1 = 0
+PRESCALE_16 = 1
+PRESCALE_256 = 2
+
+# TMRCTL bits
+_CTL_32BIT = 0x02
+_CTL_PRESCALE_SHIFT = 2
+_CTL_PRESCALE_MASK = 0x0C
+_CTL_IRQ_ENABLE = 0x20
+_CTL_ENABLE = 0x80
+_CTL_FRC_ENABLE = 0x200
+_CTL_FRC_PRESCALE_SHIFT = 16
+_CTL_FRC_PRESCALE_MASK = 0xFF0000
+
+_frc_reg = regs.register('TMRFRC')
+
+
+def configure_counter(prescaler=0):
+    '''Configures and starts the free-running counter.
+    The counter is incremented at core clock / (prescaler + 1).
+    @param prescaler: the counter pre-scaler (0..255);
+    0 gives the finest resolution
+    '''
+
+    if prescaler < 0 or prescaler > 0xFF:
+        raise Exception('Invalid prescaler')
+
+    regs.modify('TMRCTL', _CTL_FRC_PRESCALE_MASK,
+            (prescaler << _CTL_FRC_PRESCALE_SHIFT) | _CTL_FRC_ENABLE)
+
+
+def stop_counter():
+    '''Stops the free-running counter.
+    '''
+
+    regs.modify('TMRCTL', _CTL_FRC_ENABLE, 0)
+
+
+def counter():
+    '''Returns the current value of the free-running counter.
+    The counter is 32 bit wide and wraps around
+    (see counter_diff()).
+    '''
+
+    frc = _frc_reg
+
+    return frc.words[frc.index]
+
+
+def counter_diff(end, start):
+    '''Returns the number of counts between two values
+    returned by counter(), taking the wraparound into account.
+    @param end: the later value
+    @param start: the earlier value
+    '''
+
+    return (end - start) & 0xFFFFFFFF
+
+
+def configure(load, prescale=PRESCALE_1, predivider=None, reload=None):
+    '''Configures the countdown timer (without starting it).
+    The timer counts down from the load value at
+    core clock / (predivider + 1) / prescale and, upon reaching 0,
+    sets its interrupt flag and restarts from the reload value.
+    The interrupt line itself is left disabled; use expired()
+    to poll the flag instead.
+    @param load: the value to count down from (32 bit)
+    @param prescale: one of the PRESCALE_* constants
+    @param predivider: the pre-divider (0..1023);
+    if None, the current pre-divider is kept
+    @param reload: the value to restart from after reaching 0;
+    if None, the load value is used
+    '''
+
+    if prescale < PRESCALE_1 or prescale > PRESCALE_256:
+        raise Exception('Invalid prescale')
+
+    if predivider is not None:
+        if predivider < 0 or predivider > 0x3FF:
+            raise Exception('Invalid predivider')
+
+        regs.TMRDIV = predivider
+
+    if reload is None:
+        reload = load
+
+    # the interrupt line is enabled at reset
+    regs.modify('TMRCTL', _CTL_PRESCALE_MASK | _CTL_32BIT | _CTL_IRQ_ENABLE,
+            (prescale << _CTL_PRESCALE_SHIFT) | _CTL_32BIT)
+
+    regs.TMRLD = load
+    regs.TMRRLD = reload
+    regs.TMRIRQCA = 1
+
+
+def set_reload(reload):
+    '''Sets the value the countdown timer restarts from after
+    reaching 0, without affecting the current count.
+    @param reload: the reload value (32 bit)
+    '''
+
+    regs.TMRRLD = reload
+
+
+def start():
+    '''Starts the countdown timer.
+    '''
+
+    regs.modify('TMRCTL', 0, _CTL_ENABLE)
+
+
+def stop():
+    '''Stops the countdown timer.
+    '''
+
+    regs.modify('TMRCTL', _CTL_ENABLE, 0)
+
+
+def value():
+    '''Returns the current value of the countdown timer.
+    '''
+
+    return regs.TMRVAL
+
+
+def expired():
+    '''Tells whether the countdown timer has reached 0
+    since its interrupt flag was last cleared.
+    '''
+
+    return bool(regs.TMRIRQR & 0x01)
+
+
+def clear():
+    '''Clears the interrupt flag of the countdown timer.
+    '''
+
+    regs.TMRIRQCA = 1
@@ -20,6 +20,8 @@ and by other programs that use this library.
 '''
 
 import ctypes
+import threading
+import time
 
 
 # we define a nanosleep() function by importing it
@@ -40,17 +42,90 @@ class __timespec(ctypes.Structure):
     _fields_ = [('secs', ctypes.c_long), ('nsecs', ctypes.c_long)]
 
 _libc.nanosleep.argtypes = [ctypes.POINTER(__timespec), ctypes.POINTER(__timespec)]
+_libc.clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(__timespec), ctypes.POINTER(__timespec)]
+
+_CLOCK_MONOTONIC = 1 # the clock used by time.monotonic_ns()
+_TIMER_ABSTIME = 1
+
+_local = threading.local() # holds a preallocated timespec for each thread
+_sleep_latency_ns = None # the measured overhead of sleeping, see calibrate()
+
+
+def _thread_timespec():
+    '''Returns the timespec structure that is reused
+    by the calling thread.'''
+
+    timespec = getattr(_local, 'timespec', None)
+    if timespec is None:
+        timespec = _local.timespec = __timespec()
+
+    return timespec
 
 
 def nanosleep(sec, nsec):
     '''Stops the execution of the calling thread by
     a specified number of seconds and nanoseconds.
+    Note that the actual time is usually tens of microseconds longer;
+    use delay_ns() for short, precise delays.
     @param sec: the number of seconds to sleep
     @param nsec: the number of nanoseconds to sleep
     '''
 
-    sleeptime = __timespec()
+    sleeptime = _thread_timespec()
     sleeptime.secs = sec
     sleeptime.nsecs = nsec
-    remaining = __timespec()
-    _libc.nanosleep(sleeptime, remaining)
+    _libc.nanosleep(sleeptime, None)
+
+
+def calibrate(samples=20):
+    '''Measures how much longer than requested the system
+    sleeps for, which delay_ns() uses to decide between sleeping
+    and busy-waiting. This is done automatically upon the first
+    call to delay_ns(). Returns the measured latency, in nanoseconds.
+    @param samples: the number of sleeps to measure
+    '''
+
+    global _sleep_latency_ns
+
+    sleeptime = _thread_timespec()
+    now = time.monotonic_ns
+    latencies = []
+    for i in range(samples):
+        sleeptime.secs = 0
+        sleeptime.nsecs = 1
+        start = now()
+        _libc.clock_nanosleep(_CLOCK_MONOTONIC, 0, sleeptime, None)
+        latencies.append(now() - start)
+
+    # be pessimistic and use the upper quartile
+    latencies.sort()
+    _sleep_latency_ns = latencies[len(latencies) * 3 // 4]
+
+    return _sleep_latency_ns
+
+
+def delay_ns(nsec):
+    '''Delays the calling thread by (at least) a number of nanoseconds.
+    Delays shorter than the sleep latency of the system
+    (see calibrate()) are busy-waited against the monotonic clock;
+    longer delays sleep until shortly before the deadline
+    and busy-wait for the remaining time.
+    @param nsec: the number of nanoseconds to wait
+    '''
+
+    now = time.monotonic_ns
+    deadline = now() + nsec
+
+    if _sleep_latency_ns is None:
+        calibrate()
+
+    if nsec > _sleep_latency_ns:
+        wakeup = deadline - _sleep_latency_ns
+        sleeptime = _thread_timespec()
+        sleeptime.secs = wakeup // 1000000000
+        sleeptime.nsecs = wakeup % 1000000000
+        _libc.clock_nanosleep(_CLOCK_MONOTONIC, _TIMER_ABSTIME, sleeptime, None)
+
+    while now() < deadline:
+        pass
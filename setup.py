@@ -14,6 +14,7 @@ setup(
     keywords = "raspberry-pi low-level peripherals gpio library",
     url = "https://github.com/ccrisan/pilowlib",
     packages=['pilowlib'],
+    python_requires='>=3.7',
     long_description=read('README'),
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -0,0 +1,108 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import unittest
+
+from pilowlib import digital
+from pilowlib import regs
+
+
+class WaveformTest(unittest.TestCase):
+    def setUp(self):
+        regs.open(regs.MemoryBackend())
+
+    def tearDown(self):
+        regs.close()
+
+    def test_compile(self):
+        waveform = digital.Waveform([
+            (1 << 4, 0, 1000),
+            (0, 1 << 4, 2000),
+            ((1 << 33) | (1 << 5), 1 << 6, 500),
+            (0, 0, 0),
+        ])
+
+        set0 = regs.register('GPSET0').index
+        set1 = regs.register('GPSET1').index
+        clr0 = regs.register('GPCLR0').index
+
+        self.assertEqual(len(waveform), 4)
+        self.assertEqual(list(waveform.indexes), [set0, clr0, set0, set1, clr0])
+        self.assertEqual(list(waveform.values), [1 << 4, 1 << 4, 1 << 5, 1 << 1, 1 << 6])
+        self.assertEqual(list(waveform.ends), [1, 2, 5, 5])
+        self.assertEqual(list(waveform.times), [0, 1000, 3000, 3500])
+        self.assertEqual(waveform.duration, 3500)
+
+    def test_play(self):
+        waveform = digital.Waveform([
+            (1 << 4, 0, 1000),
+            ((1 << 33), 1 << 4, 0),
+        ])
+
+        late = waveform.play(2)
+
+        self.assertGreaterEqual(late, 0)
+        self.assertEqual(regs.GPSET0, 1 << 4)
+        self.assertEqual(regs.GPSET1, 1 << 1)
+        self.assertEqual(regs.GPCLR0, 1 << 4)
+
+    def test_play_clock(self):
+        waveform = digital.Waveform([
+            (1 << 4, 0, 1000),
+            (0, 1 << 4, 0),
+        ])
+
+        # a clock that advances by 500 ns at each read
+        clock = iter(range(0, 1000000, 500)).__next__
+
+        self.assertEqual(waveform.play(clock=clock), 500)
+
+    def test_invalid(self):
+        self.assertRaises(Exception, digital.Waveform, [(1 << 60, 0, 0)])
+        self.assertRaises(Exception, digital.Waveform, [(0, 0, -1)])
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        regs.open(regs.MemoryBackend())
+
+    def tearDown(self):
+        regs.close()
+
+    def test_capture(self):
+        regs.GPLEV0 = (1 << 4) | (1 << 5)
+        regs.GPLEV1 = 1 << 1
+
+        # a clock that advances by 100 ns at each read
+        clock = iter(range(0, 1000000, 100)).__next__
+
+        samples, timestamps = digital.capture((1 << 4) | (1 << 33), 3, clock=clock)
+
+        self.assertEqual(samples.typecode, 'Q')
+        self.assertEqual(list(samples), [(1 << 4) | (1 << 33)] * 3)
+        self.assertEqual(list(timestamps), [100, 200, 300])
+
+    def test_narrow_buffer(self):
+        samples = array.array('I', bytes(4 * 3))
+
+        self.assertRaises(Exception, digital.capture, 1 << 33, 3, samples)
+        self.assertEqual(len(digital.capture(1 << 4, 3, samples)[0]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from pilowlib import dma
+from pilowlib import regs
+
+
+class ControlBlockTest(unittest.TestCase):
+    def setUp(self):
+        regs.open(regs.MemoryBackend())
+
+    def tearDown(self):
+        regs.close()
+
+    def test_pack_unpack(self):
+        block = dma.ControlBlock(ti=dma.TI_SRC_INC | dma.permap(dma.PERMAP_PWM),
+                source=0xC0001000, dest=regs.register('PWMFIF').bus_address,
+                length=128, stride=0x00100010, next=0xC0000020)
+
+        data = block.pack()
+        self.assertEqual(len(data), dma.CONTROL_BLOCK_SIZE)
+
+        unpacked = dma.ControlBlock.unpack(data)
+        for name in dma.ControlBlock.__slots__:
+            self.assertEqual(getattr(unpacked, name), getattr(block, name))
+
+    def test_pack_into(self):
+        block = dma.ControlBlock(ti=1, source=2, dest=3, length=4)
+        buf = bytearray(3 * dma.CONTROL_BLOCK_SIZE)
+        block.pack_into(buf, dma.CONTROL_BLOCK_SIZE)
+
+        self.assertEqual(bytes(buf[dma.CONTROL_BLOCK_SIZE:2 * dma.CONTROL_BLOCK_SIZE]), block.pack())
+        self.assertEqual(bytes(buf[:dma.CONTROL_BLOCK_SIZE]), bytes(dma.CONTROL_BLOCK_SIZE))
+
+        unpacked = dma.ControlBlock.unpack(buf, dma.CONTROL_BLOCK_SIZE)
+        self.assertEqual((unpacked.ti, unpacked.source, unpacked.dest, unpacked.length), (1, 2, 3, 4))
+
+    def test_bus_address(self):
+        self.assertEqual(regs.register('PWMFIF').bus_address, 0x7E20C018)
+
+
+class ChainTest(unittest.TestCase):
+    def make_chain(self, loop):
+        return dma.Chain([dma.ControlBlock(ti=0, source=i, dest=0, length=4)
+                for i in range(3)], loop=loop)
+
+    def test_link(self):
+        chain = self.make_chain(False)
+        chain.link(0xC0000100)
+
+        self.assertEqual([block.next for block in chain.blocks],
+                [0xC0000120, 0xC0000140, 0])
+
+    def test_link_loop(self):
+        chain = self.make_chain(True)
+        chain.link(0xC0000100)
+
+        self.assertEqual([block.next for block in chain.blocks],
+                [0xC0000120, 0xC0000140, 0xC0000100])
+
+    def test_link_unaligned(self):
+        self.assertRaises(Exception, self.make_chain(False).link, 0xC0000110)
+
+    def test_pack_into(self):
+        chain = self.make_chain(True)
+        self.assertEqual(len(chain), 3)
+        self.assertEqual(chain.size, 3 * dma.CONTROL_BLOCK_SIZE)
+
+        buf = bytearray(chain.size + dma.CONTROL_BLOCK_SIZE)
+        address = chain.pack_into(buf, dma.CONTROL_BLOCK_SIZE, 0xC0000020)
+        self.assertEqual(address, 0xC0000020)
+
+        blocks = [dma.ControlBlock.unpack(buf, (i + 1) * dma.CONTROL_BLOCK_SIZE) for i in range(3)]
+        self.assertEqual([block.source for block in blocks], [0, 1, 2])
+        self.assertEqual([block.next for block in blocks], [0xC0000040, 0xC0000060, 0xC0000020])
+
+
+if __name__ == '__main__':
+    unittest.main()
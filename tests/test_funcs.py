@@ -0,0 +1,77 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from pilowlib import funcs
+from pilowlib import regs
+
+
+class PinMuxProfileTest(unittest.TestCase):
+    def setUp(self):
+        regs.open(regs.MemoryBackend())
+
+    def tearDown(self):
+        regs.close()
+
+    def test_writes_grouped(self):
+        profile = funcs.PinMuxProfile({
+            4: funcs.DIGITAL_OUT,
+            5: funcs.DIGITAL_IN,
+            17: funcs.DIGITAL_OUT,
+            18: funcs.PWM0,
+        })
+
+        # one write for GPFSEL0 (pins 4, 5) and one for GPFSEL1 (pins 17, 18)
+        self.assertEqual(len(profile.writes), 2)
+
+        reg, clr_mask, set_mask = profile.writes[0]
+        self.assertIs(reg, regs.register('GPFSEL0'))
+        self.assertEqual(clr_mask, (0x7 << 12) | (0x7 << 15))
+        self.assertEqual(set_mask, 0x1 << 12)
+
+        reg, clr_mask, set_mask = profile.writes[1]
+        self.assertIs(reg, regs.register('GPFSEL1'))
+        self.assertEqual(clr_mask, (0x7 << 21) | (0x7 << 24))
+        self.assertEqual(set_mask, (0x1 << 21) | (0x2 << 24)) # PWM0 is ALT5 on pin 18
+
+    def test_apply(self):
+        regs.GPFSEL0 = 0xFFFFFFFF
+        regs.GPFSEL1 = 0
+
+        funcs.PinMuxProfile({4: funcs.DIGITAL_OUT, 18: funcs.PWM0}).apply()
+
+        self.assertEqual(regs.GPFSEL0, 0xFFFFFFFF & ~(0x7 << 12) | (0x1 << 12))
+        self.assertEqual(regs.GPFSEL1, 0x2 << 24)
+
+    def test_same_as_set_gpio_funcs(self):
+        functions = {2: funcs.DIGITAL_OUT, 10: funcs.SPI0_MOSI, 18: funcs.PWM0}
+
+        regs.GPFSEL0 = regs.GPFSEL1 = 0x12345678
+        funcs.set_gpio_funcs(functions)
+        expected = (regs.GPFSEL0, regs.GPFSEL1)
+
+        regs.GPFSEL0 = regs.GPFSEL1 = 0x12345678
+        funcs.PinMuxProfile(functions).apply()
+        self.assertEqual((regs.GPFSEL0, regs.GPFSEL1), expected)
+
+    def test_invalid_function(self):
+        self.assertRaises(Exception, funcs.PinMuxProfile, {4: funcs.PWM0})
+
+
+if __name__ == '__main__':
+    unittest.main()
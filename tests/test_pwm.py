@@ -0,0 +1,155 @@
+# Copyright (c) 2012 Calin Crisan <ccrisan@gmail.com>
+#
+# This file is part of PiLowLib.
+#
+# PiLowLib is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PiLowLib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with PiLowLib.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from pilowlib import clock
+from pilowlib import pwm
+from pilowlib import regs
+
+
+class FrequencyTest(unittest.TestCase):
+    def setUp(self):
+        regs.open(regs.MemoryBackend())
+        pwm._freq_solutions.clear()
+
+    def tearDown(self):
+        regs.close()
+
+    def test_exact(self):
+        # 500 MHz / 2 / 250000
+        self.assertEqual(pwm._solve_frequency(1000), (clock.SRC_PLLD, 2, 250000))
+
+    def test_oscillator(self):
+        # 19.2 MHz / 2 / 6400000; no PLLD combination is as close
+        self.assertEqual(pwm._solve_frequency(1.5), (clock.SRC_OSC, 2, 6400000))
+
+    def test_closest(self):
+        for hz in (440, 38000, 123457):
+            src, div, rng = pwm._solve_frequency(hz)
+            src_hz = dict(pwm._FREQ_SOURCES)[src]
+            error = abs(src_hz / float(div * rng) - hz)
+
+            # no other source and divider gets closer
+            for other_src, other_hz in pwm._FREQ_SOURCES:
+                for other_div in range(pwm._FREQ_MIN_DIV, pwm._FREQ_MAX_DIV + 1):
+                    other_rng = max(2, int(other_hz / float(other_div) / hz + 0.5))
+                    other_error = abs(other_hz / float(other_div * other_rng) - hz)
+                    self.assertGreaterEqual(round(other_error / hz, 9), round(error / hz, 9))
+
+    def test_invalid(self):
+        self.assertRaises(Exception, pwm._solve_frequency, 0)
+        self.assertRaises(Exception, pwm._solve_frequency, 300000000)
+
+    def test_set_frequency(self):
+        self.assertEqual(pwm.set_frequency(0, 1000, 0.25), 1000.0)
+        self.assertEqual(pwm._freq_solutions[1000], (clock.SRC_PLLD, 2, 250000))
+        self.assertEqual(regs.CLKPWMCTL & 0x1F, 0x10 | clock.SRC_PLLD)
+        self.assertEqual((regs.CLKPWMDIV >> 12) & 0xFFF, 2)
+        self.assertEqual(regs.PWMRNG0, 250000)
+        self.assertEqual(regs.PWMDAT0, 62500)
+        self.assertTrue(regs.PWMCTL & 0x80) # M/S mode
+
+        pwm.set_duty(0, 0.5)
+        self.assertEqual(regs.PWMDAT0, 125000)
+
+    def test_set_frequency_mode(self):
+        pwm.configure(1, serial_mode=True, use_fifo=True, rev_polarity=True)
+        pwm.start(1)
+        pwm.set_frequency(1, 1000, 0.5)
+        self.assertEqual(regs.PWMCTL & 0xFF00, 0x8100) # M/S mode, enabled
+
+    def test_invalid_duty(self):
+        pwm.set_frequency(0, 1000, 0.5)
+        self.assertRaises(Exception, pwm.set_duty, 0, -0.1)
+        self.assertRaises(Exception, pwm.set_duty, 0, 1.1)
+        self.assertEqual(regs.PWMDAT0, 125000)
+
+    def test_clock_changed(self):
+        pwm.set_frequency(0, 1000, 0.5)
+        pwm.configure_clock(clock.SRC_OSC, 8)
+        clock.start('pwm')
+
+        pwm.set_frequency(0, 1000, 0.5)
+        self.assertEqual(regs.CLKPWMCTL & 0x1F, 0x10 | clock.SRC_PLLD)
+        self.assertEqual((regs.CLKPWMDIV >> 12) & 0xFFF, 2)
+
+    def test_duty_not_set(self):
+        pwm._freq_ranges[1] = None
+        self.assertRaises(Exception, pwm.set_duty, 1, 0.5)
+
+
+class LedStripTest(unittest.TestCase):
+    def setUp(self):
+        regs.open(regs.MemoryBackend())
+
+    def tearDown(self):
+        regs.close()
+
+    def bits(self, words):
+        return ''.join(format(word, '032b') for word in words)
+
+    def test_encode_3bit(self):
+        strip = pwm.LedStrip(2)
+        words = strip.encode(bytes([0xFF, 0x00, 0x80, 0x01, 0x02, 0x03]))
+
+        # GRB order, 100 for a 0 bit and 110 for a 1 bit
+        expected = ''.join(''.join('110' if byte >> i & 1 else '100' for i in range(7, -1, -1))
+                for byte in (0x00, 0xFF, 0x80, 0x02, 0x01, 0x03))
+
+        bits = self.bits(words)
+        self.assertEqual(bits[:len(expected)], expected)
+        self.assertEqual(bits[len(expected):].count('1'), 0)
+
+        # the reset time (300 us at 2.4 MHz) is covered by zero words
+        data_words = (len(expected) + 31) // 32
+        self.assertGreaterEqual((len(words) - data_words) * 32, 300 * 2.4)
+
+    def test_encode_4bit_rgbw(self):
+        strip = pwm.LedStrip(1, order='GRBW', symbol_bits=4)
+        words = strip.encode(bytes([0xFF, 0x00, 0x00, 0x01]))
+
+        self.assertEqual(list(words[:4]), [0x88888888, 0xEEEEEEEE, 0x88888888, 0x8888888E])
+        self.assertEqual(list(words[4:]), [0] * (len(words) - 4))
+
+    def test_encode_reuses_buffer(self):
+        strip = pwm.LedStrip(3)
+        first = strip.encode(bytes(range(9)))
+        second = strip.encode(bytes(9))
+
+        # the buffer only changes once a frame is queued
+        self.assertIs(first, second)
+        self.assertEqual(self.bits(second)[:9 * 24], '100' * 9 * 8)
+
+    def test_encode_partial_word(self):
+        # the padding of the last data word stays zero from frame to frame
+        strip = pwm.LedStrip(1)
+        strip.encode(bytes([0xFF, 0xFF, 0xFF]))
+        words = strip.encode(bytes(3))
+
+        bits = self.bits(words)
+        self.assertEqual(bits[:72], '100' * 24)
+        self.assertEqual(bits[72:].count('1'), 0)
+
+    def test_invalid(self):
+        self.assertRaises(Exception, pwm.LedStrip, 1, order='GRX')
+        self.assertRaises(Exception, pwm.LedStrip, 1, symbol_bits=5)
+        self.assertRaises(Exception, pwm.LedStrip(2).encode, bytes(5))
+
+
+if __name__ == '__main__':
+    unittest.main()